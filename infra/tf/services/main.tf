@@ -106,12 +106,20 @@ resource "azurerm_container_group" "olearn" {
       STORAGE_QUEUE_URL    = azurerm_storage_account.olearn.primary_queue_endpoint
       STORAGE_CONTAINER    = azurerm_storage_container.olearn.name
       STORAGE_QUEUE        = azurerm_storage_queue.olearn.name
+      ARTIFACT_CACHE_DIR   = "/cache/models"
     }
 
     # This is only needed if NOT using DefaultAzureCredential (SystemAssigned Identity)
     secure_environment_variables = {
       STORAGE_CONNECTION_STRING = var.use_azure_credential ? "" : azurerm_storage_account.olearn.primary_connection_string
     }
+
+    # Model files cache, shared by predictflower and modeller inside the group.
+    volume {
+      name       = "model-cache"
+      mount_path = "/cache"
+      empty_dir  = true
+    }
   }
 
   container {
@@ -127,12 +135,30 @@ resource "azurerm_container_group" "olearn" {
       STORAGE_QUEUE_URL    = azurerm_storage_account.olearn.primary_queue_endpoint
       STORAGE_CONTAINER    = azurerm_storage_container.olearn.name
       STORAGE_QUEUE        = azurerm_storage_queue.olearn.name
+      ARTIFACT_CACHE_DIR   = "/cache/models"
+      BUFFER_DIR           = "/buffer"
+      VAL_CACHE_DIR        = "/cache/val"
+      EMBEDDING_CACHE_DIR  = "/cache/embeddings"
     }
 
     # This is only needed if NOT using DefaultAzureCredential (SystemAssigned Identity)
     secure_environment_variables = {
       STORAGE_CONNECTION_STRING = var.use_azure_credential ? "" : azurerm_storage_account.olearn.primary_connection_string
     }
+
+    # Model files cache, shared by predictflower and modeller inside the group.
+    volume {
+      name       = "model-cache"
+      mount_path = "/cache"
+      empty_dir  = true
+    }
+
+    # Preprocessed training samples, kept over container restarts until trained.
+    volume {
+      name       = "training-buffer"
+      mount_path = "/buffer"
+      empty_dir  = true
+    }
   }
 
   tags = var.default_tags
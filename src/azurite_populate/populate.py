@@ -1,7 +1,9 @@
 import os
+import json
 import logging
+from datetime import datetime
 
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import BlobServiceClient, ContentSettings
 from azure.storage.queue import QueueServiceClient
 from azure.core.exceptions import ResourceExistsError
 
@@ -78,9 +80,32 @@ if __name__ == "__main__":
         ("datasets/", "val_data.zip")
     ]
 
+    uploaded = {}
     with get_blob_service_client() as blob_service_client:
         for prefix, file in files:
             with open(file, "rb") as data:
                 blob_client = blob_service_client.get_blob_client(STORAGE_CONTAINER, prefix + file)
-                blob_client.upload_blob(data, overwrite=True)
-                logging.info(f"Uploaded {prefix + file} to {STORAGE_CONTAINER}.")
\ No newline at end of file
+                uploaded[prefix + file] = blob_client.upload_blob(data, overwrite=True)
+                logging.info(f"Uploaded {prefix + file} to {STORAGE_CONTAINER}.")
+
+        # Point the model manifest to the base model, so services don't need to list models/
+        # An existing manifest is kept, it may already point to a newer trained model.
+        manifest = {
+            "version": 1234567890,
+            "blob": "models/flowersmodel_1234567890.keras",
+            "etag": uploaded["models/flowersmodel_1234567890.keras"]["etag"],
+            "size": os.path.getsize("flowersmodel_1234567890.keras"),
+            "artifact": "full",
+            "base": 1234567890,
+            "chain_length": 0,
+            "parent": None,
+            "metrics": {},
+            "created_at": datetime.now().isoformat(),
+        }
+        blob_client = blob_service_client.get_blob_client(STORAGE_CONTAINER, "models/manifest.json")
+        try:
+            blob_client.upload_blob(json.dumps(manifest), overwrite=False, content_settings=ContentSettings(content_type="application/json"))
+        except ResourceExistsError:
+            print(f"Manifest already exists in {STORAGE_CONTAINER}.")
+        else:
+            logging.info(f"Uploaded models/manifest.json to {STORAGE_CONTAINER}.")
\ No newline at end of file
@@ -10,6 +10,7 @@ import json
 # from time import sleep
 
 from PIL import Image
+from predict_client import PredictClient
 from azure.storage.queue import QueueServiceClient
 from azure.storage.blob import BlobServiceClient
 
@@ -25,8 +26,10 @@ azure_logger.setLevel(logging.WARNING)
 # Decide if we're running in the cloud or locally
 CLOUD = os.environ.get("USE_AZURE_CREDENTIAL", "false").lower() == "true"
 
+@st.cache_resource
 def get_blob_service_client():
     """
+    One client for the whole app, kept by streamlit between reruns and sessions.
     The STORAGE_CONNECTION_STRING is only set up when running in the cloud. 
     If it's not set, we're running locally with Azurite.
     """
@@ -38,8 +41,10 @@ def get_blob_service_client():
     else:
         return BlobServiceClient.from_connection_string(os.environ["STORAGE_CONNECTION_STRING"])
 
+@st.cache_resource
 def get_queue_service_client():
     """
+    One client for the whole app, kept by streamlit between reruns and sessions.
     The STORAGE_CONNECTION_STRING is only set up when running in the cloud. 
     If it's not set, we're running locally with Azurite.
     """
@@ -54,25 +59,77 @@ def get_queue_service_client():
 
 URL = os.environ["PREDICT_FLOWER_URL"]
 
+@st.cache_resource
+def get_predict_client() -> PredictClient:
+    # the client downscales the picture to the model input size before sending it,
+    # its connections are kept between reruns.
+    return PredictClient(URL)
+
+def image_key(image_file) -> tuple:
+    return (image_file.name, image_file.size)
+
 def call_predict(image_file) -> dict|None:
-    # POST request to api with image file included
+    # POST the downscaled image to the api
     try:
-        files = {"image_file": (image_file.name, image_file, "image/jpeg")}
-        response = requests.post(URL, files=files)
+        prediction = get_predict_client().predict(image_file.getvalue())
 
     except requests.exceptions.ConnectionError as e:
         st.warning("Failed to connect to the backend.")
         return None
 
-    # Handle response
-    if response.ok:
-        st.write("Prediction: ", response.json())
-    else:
+    # Handle error response
+    except requests.exceptions.HTTPError as e:
         st.warning("Failed to get prediction from the backend.")
-        st.write(response.text)
+        st.write(e.response.text)
+        return None
+
+    st.write("Prediction: ", prediction)
+    # the api keeps the image for a while, labeling it later only needs this hash.
+    st.session_state["image_hash"] = (image_key(image_file), prediction.get("image_hash"))
+    return prediction
+
+def upload_to_training(image_file, flower_index: int) -> str:
+    """
+    Uploads the image to blob storage and sends its name and label to the queue.
+    Only used when the api doesn't keep predicted images.
+    """
+    # Python unique file name: https://stackoverflow.com/questions/2961509/python-how-to-create-a-unique-file-name
+    image_name = f"{uuid.uuid4()}_{image_file.name}"
+
+    # upload picture as a blob: https://learn.microsoft.com/en-us/azure/storage/blobs/storage-blob-upload-python
+    container_client = get_blob_service_client().get_container_client(os.environ["STORAGE_CONTAINER"])
+    container_client.get_blob_client(image_name).upload_blob(image_file.getvalue(), overwrite=True)
+    logging.info(f"blob_file {image_name} uploaded into blob storage.")
+
+    # message in .json format, sends image_name and flower label into queue.
+    queue_client = get_queue_service_client().get_queue_client(os.environ["STORAGE_QUEUE"])
+    queue_client.send_message(json.dumps({"image_name": image_name, "label": flower_index}))
+    logging.info(f"Message ({image_name}) as ({flower_index}) sent to Queue ({os.environ['STORAGE_QUEUE']})")
+    return image_name
+
+def send_to_training(image_file, flower_index: int) -> str|None:
+    """
+    Sends the image with its label to training. A predicted image is referred to by
+    its hash, so only a small message goes out, the image is uploaded only when the
+    api can't keep images. Returns the name the image is known by, None on errors.
+    """
+    key, image_hash = st.session_state.get("image_hash", (None, None))
+    try:
+        image_hash = get_predict_client().label_image(
+            image_file.getvalue(), flower_index, image_hash if key == image_key(image_file) else None
+        )
+    except requests.exceptions.ConnectionError as e:
+        st.warning("Failed to connect to the backend.")
+        return None
+    except requests.exceptions.HTTPError as e:
+        st.warning("Failed to send the label to the backend.")
+        st.write(e.response.text)
         return None
 
-    return response.json()
+    if image_hash is None:
+        return upload_to_training(image_file, flower_index)
+    logging.info(f"Image {image_hash} labeled as ({flower_index}).")
+    return image_hash
 
 ## UI STARTS: ##
 st.title("Upload a picture and predict its species")
@@ -101,65 +158,7 @@ if image_file is not None: # if image_file is not None:
 
     if st.button("Send picture to training"):
 
-        # upload picture as a blob: https://learn.microsoft.com/en-us/azure/storage/blobs/storage-blob-upload-python
-
-        with get_blob_service_client() as blob_service_client:
-            # Python unique file name: https://stackoverflow.com/questions/2961509/python-how-to-create-a-unique-file-name
-            image_name = f"{uuid.uuid4()}_{image_file.name}"
-
-            container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
-            blob_client = container_client.get_blob_client(image_name)
-
-            with io.BytesIO(image_file.getvalue()) as uploaded_file:
-                blob_client.upload_blob(uploaded_file.read(), overwrite=True)
-
-            logging.info(f"blob_file {image_name} uploaded into blob storage.")
-
-        # Lets send image info into the queue.
-        with get_queue_service_client() as queue_service_client:
-            # upload queue client.
-            with queue_service_client.get_queue_client(os.environ["STORAGE_QUEUE"]) as queue_client:
-                #logging.info(f"image_file type3: {type(image_file)}")
-                #logging.info(f"flower_index type: {type(flower_index)}")
-                #logging.info(f"flower_index: {flower_index}")
-
-                # message in .json format.
-                message = {
-                    "image_name": image_name,
-                    "label": flower_index
-                    }
-
-                queue_client.send_message(json.dumps(message)) # sends image_name and flower label into queue as a message
-                json_dump = json.dumps(message)
-
-                #logging.info(json_dump)
-                #logging.info(message)
-                logging.info(f"Message ({image_name}) as ({label}) sent to Queue ({os.environ['STORAGE_QUEUE']})")
-
-                st.write(f"Sent: {image_name} as label {flower_list[flower_index]} to model training ({os.environ['STORAGE_QUEUE']}).")
-                st.write("You can now upload a new picture.")
-
-
-                # ## Just a test to load picture from queue, did not work...##
-                # https://github.com/Azure/azure-sdk-for-python/issues/11784
-                # https://learn.microsoft.com/en-us/azure/storage/queues/storage-queues-introduction
-                # https://learn.microsoft.com/en-us/answers/questions/905848/storage-queue-message-size-limit
-                # # load image from queue as a message.
-                # messages = queue_client.receive_messages(messages_per_page=1)
-                # logging.info(type(messages))
-
-                # for msg in messages:
-                #     logging.info(type(msg))
-                #     content = msg.content  # This should get the base64 encoded message
-                #     logging.info(type(content))
-                #     queue_client.delete_message(msg)  # delete the msg.
-                #     if content:
-                #         # Decode
-                #         image_bytes = BytesIO(base64.b64decode(content))
-                #         logging.info(len(image_bytes))
-                #         # back to image
-                #         image = Image.open(image_bytes)
-                #     st.image(image, caption="Image from Azure Queue", use_column_width=True)
-                # else:
-                #     st.write("didnt receive message/picture :(")
-
+        image_name = send_to_training(image_file, flower_index)
+        if image_name is not None:
+            st.write(f"Sent: {image_name} as label {flower_list[flower_index]} to model training ({os.environ['STORAGE_QUEUE']}).")
+            st.write("You can now upload a new picture.")
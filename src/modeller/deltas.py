@@ -0,0 +1,57 @@
+import io
+import hashlib
+import numpy as np
+
+# This file is the same in predictflower and modeller, both read and write the same delta format.
+
+def layer_of(weight) -> str:
+    """Layer part of a weight path, "dense/kernel" -> "dense"."""
+    return weight.path.rsplit("/", 1)[0]
+
+def weight_delta(parent_weights: list, model) -> dict:
+    """
+    Weights of the layers that changed from the parent, keyed by their index in model.weights.
+    A layer is taken whole when any of its weights changed, unchanged layers are skipped.
+    """
+    changed_layers = set()
+    for parent_weight, weight in zip(parent_weights, model.weights):
+        if not np.array_equal(parent_weight, np.asarray(weight.numpy())):
+            changed_layers.add(layer_of(weight))
+    return {
+        index: np.asarray(weight.numpy())
+        for index, weight in enumerate(model.weights) if layer_of(weight) in changed_layers
+    }
+
+def serialize_delta(delta: dict, model) -> bytes:
+    """Compressed npz of the changed weights, with their paths to check against the model they are applied to."""
+    arrays = {f"w{index}": delta[index] for index in sorted(delta)}
+    arrays["paths"] = np.array([model.weights[index].path for index in sorted(delta)])
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    return buffer.getvalue()
+
+def delta_checksum(delta_bytes: bytes) -> str:
+    return hashlib.sha256(delta_bytes).hexdigest()
+
+def deserialize_delta(delta_bytes: bytes, checksum: str) -> list:
+    """
+    Delta back into (index, path, array) entries.
+    Raises ValueError when the bytes don't match the published checksum.
+    """
+    if delta_checksum(delta_bytes) != checksum:
+        raise ValueError("Model delta checksum does not match.")
+    with np.load(io.BytesIO(delta_bytes)) as arrays:
+        indexes = sorted(int(name[1:]) for name in arrays.files if name.startswith("w"))
+        return [(index, str(path), arrays[f"w{index}"]) for index, path in zip(indexes, arrays["paths"])]
+
+def apply_delta(model, entries: list):
+    """
+    Overwrites the changed weights of the model in place.
+    Paths are compared by suffix, a cloned model may sit under an extra name scope.
+    """
+    for index, path, array in entries:
+        weight = model.weights[index]
+        same_path = weight.path.endswith(path) or path.endswith(weight.path)
+        if not same_path or tuple(weight.shape) != array.shape:
+            raise ValueError(f"Model delta weight {path} does not fit the model.")
+        weight.assign(array)
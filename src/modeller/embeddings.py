@@ -0,0 +1,117 @@
+import os
+import re
+import shutil
+import hashlib
+import logging
+import tempfile
+import numpy as np
+import keras
+
+from preprocessing import normalize
+
+# Images run through the frozen backbone at a time when embeddings are computed.
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "64"))
+# Local directory of cached embeddings, one folder per backbone.
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", "./embedding_cache")
+# Backbones whose embeddings are kept, older folders are removed.
+EMBEDDING_CACHE_BACKBONES = int(os.environ.get("EMBEDDING_CACHE_BACKBONES", "2"))
+
+# Head training in the "head" training mode.
+HEAD_EPOCHS = int(os.environ.get("HEAD_EPOCHS", "10"))
+HEAD_BATCH_SIZE = int(os.environ.get("HEAD_BATCH_SIZE", "32"))
+HEAD_LEARNING_RATE = float(os.environ.get("HEAD_LEARNING_RATE", "0.001"))
+
+def split_model(model) -> tuple:
+    """
+    Splits the model into a feature extractor (everything but the last layer)
+    and the classifier head (the last layer, which gives the logits).
+    The head layer is shared, training it trains the full model too.
+    """
+    head_layer = model.layers[-1]
+    if not head_layer.weights:
+        raise ValueError(f"Last layer {head_layer.name} has no weights, can't train it as the head.")
+    backbone = keras.Model(model.inputs, head_layer.input)
+
+    head = keras.Sequential([keras.Input(shape=backbone.output.shape[1:]), head_layer])
+    head.compile(
+        optimizer=keras.optimizers.Adam(HEAD_LEARNING_RATE),
+        loss=model.loss or keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+        metrics=["accuracy"]
+    )
+    return backbone, head
+
+def backbone_hash(backbone) -> str:
+    """Hash of the backbone weights, embeddings stay valid as long as it doesn't change."""
+    digest = hashlib.sha256()
+    for weight in backbone.weights:
+        digest.update(np.ascontiguousarray(keras.ops.convert_to_numpy(weight)).tobytes())
+    return digest.hexdigest()[:16]
+
+def compute_embeddings(backbone, images) -> np.ndarray:
+    """Embeddings of uint8 images, read from the (memory mapped) array one batch at a time."""
+    outputs = []
+    for start in range(0, len(images), EMBEDDING_BATCH_SIZE):
+        batch = normalize(np.asarray(images[start:start + EMBEDDING_BATCH_SIZE]))
+        outputs.append(keras.ops.convert_to_numpy(backbone(batch, training=False)))
+    if not outputs:
+        return np.zeros((0,) + tuple(backbone.output.shape[1:]), dtype=np.float32)
+    return np.concatenate(outputs).astype(np.float32)
+
+class EmbeddingCache:
+    """
+    Backbone outputs of stored image sets (buffer shards, the validation set)
+    on local disk, keyed by backbone hash and set name.
+
+    In head-only training the backbone never changes, so every image goes through
+    it once, later cycles only read the cached vectors. A full retrain changes the
+    hash and the embeddings are computed again under the new one.
+    """
+    def __init__(self, backbone, directory: str = EMBEDDING_CACHE_DIR):
+        self.backbone = backbone
+        self.key = backbone_hash(backbone)
+        self.directory = os.path.join(directory, self.key)
+        os.makedirs(self.directory, exist_ok=True)
+        os.utime(self.directory)
+        self.computed = 0
+        self.reused = 0
+        self._remove_old_backbones(directory)
+
+    def get(self, name: str, images) -> np.ndarray:
+        """Embeddings of the named image set, computed and saved on the first call."""
+        path = os.path.join(self.directory, f"{re.sub('[^0-9A-Za-z_.-]', '', name)}.npy")
+        try:
+            embeddings = np.load(path)
+            self.reused += len(embeddings)
+            return embeddings
+        except FileNotFoundError:
+            pass
+
+        embeddings = compute_embeddings(self.backbone, images)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(file_descriptor, "wb") as temp_file:
+            np.save(temp_file, embeddings)
+        os.replace(temp_path, path)
+        self.computed += len(embeddings)
+        return embeddings
+
+    def _remove_old_backbones(self, directory: str):
+        folders = sorted(
+            (entry for entry in os.scandir(directory) if entry.is_dir()),
+            key=lambda entry: entry.stat().st_mtime,
+            reverse=True
+        )
+        for entry in folders[EMBEDDING_CACHE_BACKBONES:]:
+            if entry.path != self.directory:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                logging.info(f"Removed embeddings of old backbone {entry.name}.")
+
+def train_head(head, embeddings: np.ndarray, labels: np.ndarray, val_embeddings: np.ndarray, val_labels: np.ndarray) -> dict:
+    """Fits the head on cached embeddings and returns its validation metrics."""
+    head.fit(
+        embeddings, labels,
+        epochs=HEAD_EPOCHS,
+        batch_size=HEAD_BATCH_SIZE,
+        shuffle=True,
+        verbose=2
+    )
+    return head.evaluate(val_embeddings, val_labels, batch_size=256, verbose=2, return_dict=True)
@@ -0,0 +1,124 @@
+import os
+import uuid
+import logging
+import threading
+import time
+
+from azure.core.exceptions import AzureError, HttpResponseError, ResourceExistsError
+
+from utils import get_blob_service_client, REPLICA_NAME
+
+# Blob whose lease tells which modeller replica is the leader.
+LEADER_BLOB = os.environ.get("LEADER_BLOB", "locks/modeller-leader")
+# Lease length in seconds (storage allows 15-60), renewed every third of it.
+LEADER_LEASE_SECONDS = int(os.environ.get("LEADER_LEASE_SECONDS", "60"))
+# Every replica touches a blob of its own here on each lease round, so the leader knows who else runs.
+REPLICAS_PREFIX = os.environ.get("REPLICAS_PREFIX", "locks/modeller-replicas/")
+
+class LeaderLease:
+    """
+    Leader election between modeller replicas with a blob lease.
+
+    Every replica trains on the messages it receives and publishes versions
+    optimistically, but singleton jobs (bootstrapping the manifest, cleaning up
+    old versions, full retrains) run only on the leader. A background thread
+    keeps trying to take the lease and renews it while held. If renewing fails
+    or the thread falls behind, leadership is given up before the lease can
+    expire, so two replicas never both think they lead. Storage or connection
+    errors also give leadership up, the thread keeps trying.
+    The thread also keeps a heartbeat blob of this replica, other_replicas()
+    tells which other replicas are alive.
+    """
+    def __init__(self, blob_name: str = LEADER_BLOB, lease_seconds: int = LEADER_LEASE_SECONDS):
+        self.blob_name = blob_name
+        self.lease_seconds = lease_seconds
+        self._lease = None
+        self._valid_until = 0.0
+        self._stopping = threading.Event()
+        self._thread = None
+        # unique per process, replicas may share a hostname.
+        self._heartbeat_blob = f"{REPLICAS_PREFIX}{REPLICA_NAME}_{uuid.uuid4().hex[:8]}"
+
+    @property
+    def is_leader(self) -> bool:
+        # a safety margin of one renew interval, the lease itself lasts longer.
+        return self._lease is not None and time.monotonic() < self._valid_until - self.lease_seconds / 3
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="leader-lease", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._lease is not None:
+            try:
+                self._lease.release()
+            except AzureError:
+                pass
+            self._lease = None
+
+    def _run(self):
+        with get_blob_service_client() as blob_service_client:
+            container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
+            blob_client = container_client.get_blob_client(self.blob_name)
+            created = False
+            while not self._stopping.is_set():
+                try:
+                    if not created:
+                        try:
+                            blob_client.upload_blob(b"", overwrite=False)
+                        except ResourceExistsError:
+                            pass
+                        created = True
+                    self._renew_or_acquire(blob_client)
+                    container_client.get_blob_client(self._heartbeat_blob).upload_blob(REPLICA_NAME.encode(), overwrite=True)
+                except AzureError:
+                    # connection errors are not HttpResponseErrors, without this the thread would die.
+                    if self._lease is not None:
+                        logging.warning(f"{REPLICA_NAME} gave up the modeller leader lease.")
+                    logging.exception("Leader lease check failed.")
+                    self._lease = None
+                self._stopping.wait(self.lease_seconds / 3)
+
+    def other_replicas(self) -> list:
+        """
+        Names of the other replicas that sent a heartbeat within three lease rounds.
+        Heartbeats older than an hour (stopped replicas) are deleted.
+        """
+        now = time.time()
+        alive = []
+        with get_blob_service_client() as blob_service_client:
+            container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
+            for blob in container_client.list_blobs(name_starts_with=REPLICAS_PREFIX):
+                age = now - blob.last_modified.timestamp()
+                if blob.name == self._heartbeat_blob:
+                    continue
+                if age < self.lease_seconds:
+                    alive.append(blob.name[len(REPLICAS_PREFIX):])
+                elif age > 3600:
+                    try:
+                        container_client.delete_blob(blob.name)
+                    except AzureError:
+                        pass
+        return alive
+
+    def _renew_or_acquire(self, blob_client):
+        started = time.monotonic()
+        if self._lease is not None:
+            try:
+                self._lease.renew()
+                self._valid_until = started + self.lease_seconds
+            except HttpResponseError:
+                logging.warning(f"{REPLICA_NAME} lost the modeller leader lease.")
+                self._lease = None
+            return
+
+        try:
+            self._lease = blob_client.acquire_lease(lease_duration=self.lease_seconds)
+            self._valid_until = started + self.lease_seconds
+            logging.info(f"{REPLICA_NAME} is now the modeller leader.")
+        except HttpResponseError:
+            # another replica holds the lease.
+            pass
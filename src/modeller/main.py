@@ -2,7 +2,7 @@ import joblib
 import time
 import logging
 import time
-import tempfile
+import numpy as np
 import tensorflow as tf
 import keras
 import os
@@ -11,13 +11,35 @@ from datetime import datetime
 from io import BytesIO
 
 from utils import (
-    n_images_waiting,
-    load_dataset,
-    get_all_from_queue,
-    upload_model,
-    latest_model_version,
-    load_model
+    ingest_queue,
+    publish_model_artifact,
+    latest_manifest,
+    delete_version_blobs,
+    ManifestConflict,
+    load_model,
+    publish_manifest,
+    publish_tflite,
+    load_validation_cache
 )
+from preprocessing import normalize
+from trigger import TrainingTrigger, label_to_model_seconds
+from shards import ShardBuffer
+from pipeline import training_dataset, TRAIN_BATCH_SIZE, TRAIN_EPOCHS
+from embeddings import EmbeddingCache, split_model, train_head
+from leader import LeaderLease
+from retrain import full_retrain, retrain_due, record_failed_retrain
+from retention import apply_retention, RETENTION_INTERVAL_SECONDS
+from azure.core.exceptions import ResourceExistsError
+
+# Already trained samples mixed into every cycle from the local buffer.
+REPLAY_SAMPLES = int(os.environ.get("REPLAY_SAMPLES", "0"))
+
+# "head" trains only the last layer on cached embeddings of the frozen rest of the model,
+# "full" trains the whole network.
+TRAINING_MODE = os.environ.get("TRAINING_MODE", "head").lower()
+
+# How often (seconds) an idle modeller looks if a full retrain is due.
+RETRAIN_CHECK_SECONDS = float(os.environ.get("RETRAIN_CHECK_SECONDS", "600"))
 
 # Set the logging level for this script
 logging.basicConfig(level=logging.INFO)
@@ -26,87 +48,211 @@ logging.basicConfig(level=logging.INFO)
 azure_logger = logging.getLogger("azure")
 azure_logger.setLevel(logging.WARNING)
 
-load_dataset()
-
-#["dandelion", "daisy", "tulips", "sunflowers", "roses"]
-os.rename("./val/dandelion", "./val/0_dandelion")
-os.rename("./val/daisy", "./val/1_daisy")
-os.rename("./val/tulips", "./val/2_tulips")
-os.rename("./val/sunflowers", "./val/3_sunflowers")
-os.rename("./val/roses", "./val/4_roses")
+# validation images are decoded once per zip version, with the same preprocessing as in predictflower.
+val_images, val_labels = load_validation_cache()
 
 def format_images(image, label):
-    image_res = 224
-    formated_image = tf.image.resize(image, (image_res, image_res))/255.0
-    return formated_image, label
+    return normalize(image), label
 
-while True:
-    n_images = n_images_waiting()
-    if n_images > 1:
-
-        # lets load model like we did in prediction:
-        latest_model_version = latest_model_version()
-        logging.info(f"Latest model version: {latest_model_version}")
-
-        model_bytes = load_model(latest_model_version) 
-
-        #bytes into path, wont be deleting temp file.
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".keras") as temp_file:
-            temp_file.write(model_bytes) # model bytes to tempfile.
-            temp_file_path = temp_file.name
-        
-        # load the model
-        model = tf.keras.models.load_model(temp_file_path)
-        logging.info(f"model: {model.summary(show_trainable=True)}")
-
-        # Use current UNIX time as the version of the model
-        model_version = int(time.time())
-        iso_time = datetime.fromtimestamp(model_version).isoformat()
-        logging.info(
-            f"Found {n_images} images in Queue at {model_version} ({iso_time})."
+def train_full(model, pending: list, val_batches) -> dict:
+    """Trains the whole network on the pending samples, returns validation metrics."""
+    replay_shards = buffer.trained_shards() if REPLAY_SAMPLES > 0 else []
+    train_batches = training_dataset(pending, replay_shards, REPLAY_SAMPLES)
+    logging.info(f"Training on {int(train_batches.cardinality())} batches of up to {TRAIN_BATCH_SIZE} samples.")
+
+    # train the model
+    history = model.fit(train_batches, epochs=TRAIN_EPOCHS)
+
+    # evaluate
+    return model.evaluate(val_batches, verbose=2, return_dict=True)
+
+def train_head_only(model, pending: list) -> dict:
+    """
+    Trains only the classifier head on cached backbone embeddings, returns validation metrics.
+    Every image goes through the frozen backbone once, the head trains on small vectors.
+    """
+    started = time.time()
+    backbone, head = split_model(model)
+    embedding_cache = EmbeddingCache(backbone)
+
+    embeddings = np.concatenate([embedding_cache.get(shard.name, shard.images()) for shard in pending])
+    labels = np.concatenate([shard.labels() for shard in pending])
+
+    if REPLAY_SAMPLES > 0:
+        trained = buffer.trained_shards()
+        if trained:
+            replay_embeddings = np.concatenate([embedding_cache.get(shard.name, shard.images()) for shard in trained])
+            replay_labels = np.concatenate([shard.labels() for shard in trained])
+            chosen = np.random.default_rng().choice(len(replay_labels), size=min(REPLAY_SAMPLES, len(replay_labels)), replace=False)
+            logging.info(f"Replaying {len(chosen)} earlier samples.")
+            embeddings = np.concatenate([embeddings, replay_embeddings[chosen]])
+            labels = np.concatenate([labels, replay_labels[chosen]])
+
+    # the validation cache folder is named by the zip ETag, so is its embedding set.
+    val_name = os.path.basename(os.path.dirname(val_images.filename))
+    val_embeddings = embedding_cache.get(val_name, val_images)
+    embedded = time.time()
+
+    metrics = train_head(head, embeddings, labels, val_embeddings, val_labels)
+    logging.info(
+        f"Head trained on {len(labels)} samples: embeddings {embedded - started:.1f} s "
+        f"({embedding_cache.computed} computed, {embedding_cache.reused} cached), training {time.time() - embedded:.1f} s."
+    )
+    return metrics
+
+def validation_batches():
+    """validation dataset from loaded data, also used for the TFLite export"""
+    val_ds = tf.data.Dataset.from_tensor_slices((val_images, val_labels)).batch(32)
+    return val_ds.map(format_images).prefetch(tf.data.AUTOTUNE)
+
+def publish_version(model, model_version: int, manifest: dict, manifest_etag: str, metrics: dict, val_batches, parent_weights: list | None = None) -> bool:
+    """
+    Uploads the model (as a delta on top of the manifest's version when parent_weights
+    are given) and points the manifest to it, only if no other replica published a
+    version on top of our parent meanwhile. Returns False on a conflict.
+    """
+    parent_version = manifest["version"]
+    # only the files this call uploaded are removed on a conflict, the same version
+    # number may have been published by another replica.
+    uploaded = []
+    try:
+        artifact = publish_model_artifact(model, model_version, parent_weights, manifest)
+        uploaded.append(artifact)
+        tflite = publish_tflite(model, model_version, val_batches)
+        if tflite is not None:
+            uploaded.append(tflite)
+        publish_manifest(
+            model_version, artifact, metrics, tflite,
+            parent=parent_version, expected_etag=manifest_etag
         )
+    except ManifestConflict as error:
+        logging.warning(f"Version {model_version} on top of {parent_version} was not published: {error}")
+        delete_version_blobs(model_version, uploaded)
+        return False
+    except ResourceExistsError:
+        logging.warning(f"Another replica took version {model_version}.")
+        delete_version_blobs(model_version, uploaded)
+        return False
+    return True
+
+def run_training_cycle():
+    """
+    One training cycle: takes the waiting labeled images, fine-tunes the latest model
+    with them and publishes the result as a new version.
+    """
+    # Move the waiting images into the local buffer, then train on everything not trained yet.
+    # Shards left pending by a failed cycle are picked up again here.
+    # The model is only loaded when there is something to train.
+    ingest_queue(buffer)
+    pending = buffer.pending_shards()
+    if not pending:
+        logging.info(f"No dataset found")
+        return
+
+    # lets load model like we did in prediction:
+    manifest, manifest_etag = latest_manifest(bootstrap=lease.is_leader)
+    if manifest is None:
+        logging.info("No manifest yet, waiting for the leader to publish it.")
+        time.sleep(10)
+        return
+    parent_version = manifest["version"]
+    logging.info(f"Latest model version: {parent_version}")
 
-        # Get all the images from the blob storage using messages in queue, deleting them from the queue
-        # Note that this is a risk; if the following process fails, the images are lost
-        dataset = get_all_from_queue()
-        logging.info({len(dataset)})
-        images = [image[0] for image in dataset]
-        labels = [label[1] for label in dataset]
-        logging.info({len(dataset)})
-
-        if len(dataset) > 0:
-            train_ds = tf.data.Dataset.from_tensor_slices((images, labels))
-            train_ds = train_ds.batch(len(dataset)).shuffle(len(dataset))
-
-            # validation dataset from loaded data
-            val_ds = keras.utils.image_dataset_from_directory("./val/",
-                                                              validation_split=None,
-                                                              seed=123,
-                                                              image_size=(224, 224),
-                                                              batch_size=32
-                                                              )
-            
-            # prepare batches
-            train_batches = train_ds.map(format_images).prefetch(tf.data.AUTOTUNE)
-            val_batches = val_ds.map(format_images).prefetch(tf.data.AUTOTUNE)
-
-            # train the model
-            history = model.fit(train_batches,
-                                epochs=3,
-                                batch_size=len(dataset)
-                                )
-
-            # evaluate
-            model.evaluate(val_batches, verbose=2)
-            
-            # upload model to blob storage
-            model.save("temp_model.keras")
-            upload_model("temp_model.keras", f"models/flowersmodel_{model_version}.keras")
-
-            logging.info(f"Model version {model_version} is now available.")
-        else:
-            logging.info(f"No dataset found")
+    model = load_model(parent_version, manifest)
+    # the new version is published as the change from these.
+    parent_weights = model.get_weights()
+
+    # Use current UNIX time as the version of the model, always newer than the parent
+    model_version = max(int(time.time()), parent_version + 1)
+    iso_time = datetime.fromtimestamp(model_version).isoformat()
+    logging.info(f"Starting training cycle at {model_version} ({iso_time}).")
+
+    val_batches = validation_batches()
+    if TRAINING_MODE == "head":
+        metrics = train_head_only(model, pending)
     else:
-        logging.info("Waiting images to process.")
+        metrics = train_full(model, pending, val_batches)
+    
+    # freshness: how long the labels took to end up in a published model.
+    metrics.update(label_to_model_seconds([timestamp for shard in pending for timestamp in shard.labeled_at]))
+
+    # on a conflict the samples stay pending and are trained again on top of the new version.
+    if not publish_version(model, model_version, manifest, manifest_etag, metrics, val_batches, parent_weights):
+        return
+
+    logging.info(
+        f"Model version {model_version} is now available, "
+        f"label to model max {metrics.get('label_to_model_max_seconds', 0):.0f} s."
+    )
+    buffer.mark_trained(pending)
+
+def run_full_retrain():
+    """
+    Leader only: retrains the whole latest model on every sample in the buffer
+    with data parallel worker processes and publishes it as a new version.
+    The buffer is local, samples other replicas ingested are not in it, so this
+    only runs while the leader is the only modeller replica.
+    """
+    others = lease.other_replicas()
+    if others:
+        raise RuntimeError(
+            f"Full retrain needs a single modeller replica, {', '.join(others)} also run "
+            f"and keep their samples in their own buffers. Set RETRAIN_INTERVAL_SECONDS=0 when scaling out."
+        )
+
+    manifest, manifest_etag = latest_manifest(bootstrap=True)
+    shards = buffer.shards()
+    if manifest is None or not shards:
+        return
+    parent_version = manifest["version"]
+    model_version = max(int(time.time()), parent_version + 1)
+    logging.info(f"Starting full retrain of version {parent_version} on {len(shards)} shards.")
+
+    parent = load_model(parent_version, manifest)
+    parent.save("parent_model.keras")
+    stats = full_retrain("parent_model.keras", shards, "retrained_model.keras")
+
+    # workers save the weights only, the training setup comes from the parent.
+    model = keras.saving.load_model("retrained_model.keras", compile=False)
+    model.compile_from_config(parent.get_compile_config())
+
+    val_batches = validation_batches()
+    metrics = model.evaluate(val_batches, verbose=2, return_dict=True)
+    metrics["retrain_samples_per_second"] = stats["samples_per_second"]
+    for workers, scaling in stats["scaling"].items():
+        metrics[f"retrain_scaling_efficiency_{workers}"] = scaling["efficiency"]
+
+    # every layer changed, a full file starts a new delta chain.
+    if publish_version(model, model_version, manifest, manifest_etag, metrics, val_batches):
+        logging.info(f"Fully retrained model version {model_version} is now available.")
+        buffer.mark_trained([shard for shard in shards if not shard.trained])
+
+lease = LeaderLease()
+lease.start()
+buffer = ShardBuffer()
+trigger = TrainingTrigger()
+last_retention = 0.0
+
+while True:
+    if lease.is_leader and retrain_due():
+        try:
+            run_full_retrain()
+        except Exception:
+            # keep training the incremental cycles, the retrain is tried again after the interval.
+            logging.exception("Full retrain failed.")
+            record_failed_retrain()
+
+    # old model versions are cleaned up by the leader only.
+    if lease.is_leader and RETENTION_INTERVAL_SECONDS > 0 and time.time() - last_retention >= RETENTION_INTERVAL_SECONDS:
+        try:
+            apply_retention()
+        except Exception:
+            # nothing is lost by waiting, cleaning up is tried again after the interval.
+            logging.exception("Applying retention failed.")
+        last_retention = time.time()
 
-    time.sleep(10)
+    # blocks until enough images wait or the oldest one is old enough,
+    # unless a failed cycle left samples in the buffer.
+    if not buffer.pending_shards() and trigger.wait(max_wait_seconds=RETRAIN_CHECK_SECONDS) is None:
+        continue
+    run_training_cycle()
@@ -0,0 +1,69 @@
+import os
+import numpy as np
+import tensorflow as tf
+
+from preprocessing import IMAGE_SIZE, normalize
+
+# Full training input: samples per batch, random flips and brightness changes, epochs.
+TRAIN_BATCH_SIZE = int(os.environ.get("TRAIN_BATCH_SIZE", "32"))
+TRAIN_AUGMENT = os.environ.get("TRAIN_AUGMENT", "true").lower() == "true"
+TRAIN_EPOCHS = int(os.environ.get("TRAIN_EPOCHS", "3"))
+
+def augment(image, label):
+    """uint8 image into a randomly flipped and brightened float32 model input, runs in the graph."""
+    image = normalize(image)
+    if TRAIN_AUGMENT:
+        image = tf.image.random_flip_left_right(image)
+        image = tf.image.random_brightness(image, max_delta=0.1)
+        image = tf.clip_by_value(image, 0.0, 1.0)
+    return image, label
+
+def training_dataset(
+    shards: list,
+    replay_shards: list = (),
+    replay_samples: int = 0,
+    batch_size: int = TRAIN_BATCH_SIZE,
+    rng=None,
+    worker_index: int = 0,
+    worker_count: int = 1
+) -> tf.data.Dataset:
+    """
+    Streams (image, label) batches from buffer shards.
+
+    Only (shard, row) pairs are kept in memory. Every epoch visits them in a new
+    random order, so samples (not batches) are shuffled across all shards, and
+    images are read from the memory mapped shards one at a time. Normalizing
+    and augmenting run as a parallel map in the graph, batches are prefetched.
+    replay_samples rows are drawn from replay_shards once and added to the set.
+    With several training workers each one streams every worker_count-th sample.
+    """
+    rng = rng or np.random.default_rng()
+    all_shards = list(shards) + list(replay_shards)
+
+    index = [(shard_index, row) for shard_index, shard in enumerate(shards) for row in range(len(shard))]
+    replay_index = [
+        (len(shards) + shard_index, row)
+        for shard_index, shard in enumerate(replay_shards) for row in range(len(shard))
+    ]
+    if replay_samples > 0 and replay_index:
+        chosen = rng.choice(len(replay_index), size=min(replay_samples, len(replay_index)), replace=False)
+        index += [replay_index[position] for position in chosen]
+    index = np.array(index, dtype=np.int64).reshape(-1, 2)[worker_index::worker_count]
+
+    def generate():
+        images = [shard.images() for shard in all_shards]
+        labels = [shard.labels() for shard in all_shards]
+        for shard_index, row in index[rng.permutation(len(index))]:
+            yield images[shard_index][row], labels[shard_index][row]
+
+    width, height = IMAGE_SIZE
+    dataset = tf.data.Dataset.from_generator(
+        generate,
+        output_signature=(
+            tf.TensorSpec(shape=(height, width, 3), dtype=tf.uint8),
+            tf.TensorSpec(shape=(), dtype=tf.int32),
+        )
+    )
+    dataset = dataset.apply(tf.data.experimental.assert_cardinality(len(index)))
+    dataset = dataset.map(augment, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
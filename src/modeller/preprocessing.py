@@ -0,0 +1,41 @@
+import numpy as np
+import tensorflow as tf
+
+from io import BytesIO
+from PIL import Image
+
+# Model input size, width x height.
+IMAGE_SIZE = (224, 224)
+
+# This file is the same in predictflower and modeller, training and serving
+# must see exactly the same pixels.
+
+def decode_image(image_bytes: bytes, size: tuple = IMAGE_SIZE) -> np.ndarray:
+    """
+    Decodes image bytes into a height x width x 3 uint8 array of the model input size.
+
+    For JPEGs draft() makes the decoder scale down by 1/2, 1/4 or 1/8 already in
+    the DCT domain, to the smallest scale still at least the target size, so a
+    12 MP photo is never decoded at full resolution. The rest is a bilinear resize.
+    """
+    with Image.open(BytesIO(image_bytes)) as image:
+        image.draft("RGB", size)
+        image = image.convert("RGB")
+        if image.size != size:
+            image = image.resize(size, Image.Resampling.BILINEAR)
+        return np.asarray(image, dtype=np.uint8)
+
+def decode_batch(images: list, executor=None) -> np.ndarray:
+    """
+    Decodes a list of image bytes into one N x height x width x 3 uint8 array.
+    With an executor the images are decoded in parallel, PIL releases the GIL while decoding.
+    """
+    mapper = executor.map if executor is not None else map
+    return np.stack(list(mapper(decode_image, images)))
+
+def normalize(images):
+    """
+    uint8 images into float32 model input in [0, 1].
+    Takes numpy arrays and tf tensors, so tf.data pipelines use this very same function.
+    """
+    return tf.cast(images, tf.float32) / 255.0
@@ -0,0 +1,99 @@
+import os
+import re
+import json
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.exceptions import ResourceNotFoundError
+
+from utils import get_blob_service_client, read_manifest, version_record_blob
+
+# Model versions kept by the cleanup: the newest ones, pinned ones, and the best ones by a validation metric.
+RETAIN_LAST_VERSIONS = int(os.environ.get("RETAIN_LAST_VERSIONS", "10"))
+RETAIN_PINNED_VERSIONS = [int(version) for version in os.environ.get("RETAIN_PINNED_VERSIONS", "").split(",") if version.strip()]
+RETAIN_BEST_VERSIONS = int(os.environ.get("RETAIN_BEST_VERSIONS", "1"))
+RETAIN_BEST_METRIC = os.environ.get("RETAIN_BEST_METRIC", "accuracy")
+# "delete" removes the other versions, "archive" moves their blobs to the Archive access tier.
+RETENTION_MODE = os.environ.get("RETENTION_MODE", "delete").lower()
+# How often (seconds) the leader cleans up models/.
+RETENTION_INTERVAL_SECONDS = float(os.environ.get("RETENTION_INTERVAL_SECONDS", "3600"))
+
+VERSION_BLOB = re.compile(r"^models/flowersmodel_(\d+)\.")
+
+def list_version_blobs(container_client) -> dict:
+    """
+    {version: [(blob name, size)]} of everything under models/flowersmodel_, one listing.
+    Already archived blobs are left out, they are done.
+    """
+    versions = {}
+    for blob in container_client.list_blobs(name_starts_with="models/flowersmodel_"):
+        match = VERSION_BLOB.match(blob.name)
+        if match and blob.blob_tier != "Archive":
+            versions.setdefault(int(match.group(1)), []).append((blob.name, blob.size))
+    return versions
+
+def read_records(container_client, versions: list) -> dict:
+    """Version records read in parallel. Versions without one are full .keras files."""
+    def read(version):
+        try:
+            return json.loads(container_client.get_blob_client(version_record_blob(version)).download_blob().readall())
+        except ResourceNotFoundError:
+            return {"version": version, "artifact": "full"}
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return dict(zip(versions, executor.map(read, versions)))
+
+def versions_to_keep(manifest_version: int, records: dict) -> set:
+    """
+    The newest RETAIN_LAST_VERSIONS up to the manifest's version, pinned versions,
+    the RETAIN_BEST_VERSIONS best by RETAIN_BEST_METRIC, and every version a kept
+    delta version is built from. Versions newer than the manifest may still be on
+    their way in from another replica and are never touched.
+    """
+    published = sorted(version for version in records if version <= manifest_version)
+    keep = {version for version in records if version > manifest_version}
+    keep.add(manifest_version)
+    keep.update(published[-RETAIN_LAST_VERSIONS:] if RETAIN_LAST_VERSIONS > 0 else [])
+    keep.update(version for version in RETAIN_PINNED_VERSIONS if version in records)
+
+    scored = [version for version in published if RETAIN_BEST_METRIC in records[version].get("metrics", {})]
+    scored.sort(key=lambda version: records[version]["metrics"][RETAIN_BEST_METRIC], reverse=True)
+    keep.update(scored[:RETAIN_BEST_VERSIONS])
+
+    for version in list(keep):
+        record = records.get(version, {})
+        while record.get("artifact") == "delta" and record.get("parent") in records:
+            keep.add(record["parent"])
+            record = records[record["parent"]]
+    return keep
+
+def apply_retention() -> dict:
+    """
+    Deletes (or archives) the model versions the retention policy doesn't keep.
+    Blobs go in batch requests of 256. A version's record goes first, so nobody
+    finds a version whose files are already gone.
+    Returns how many versions and bytes were removed.
+    """
+    manifest, _ = read_manifest()
+    if manifest is None:
+        return {"versions": 0, "bytes": 0}
+
+    with get_blob_service_client() as blob_service_client:
+        container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
+        blobs = list_version_blobs(container_client)
+        records = read_records(container_client, sorted(blobs))
+        keep = versions_to_keep(manifest["version"], records)
+
+        removed = sorted(version for version in blobs if version not in keep)
+        record_names = {version_record_blob(version) for version in removed}
+        names = sorted((name for version in removed for name, _ in blobs[version]), key=lambda name: name not in record_names)
+        freed = sum(size for version in removed for _, size in blobs[version])
+
+        for start in range(0, len(names), 256):
+            if RETENTION_MODE == "archive":
+                container_client.set_standard_blob_tier_blobs("Archive", *names[start:start + 256], raise_on_any_failure=False)
+            else:
+                container_client.delete_blobs(*names[start:start + 256], raise_on_any_failure=False)
+
+    action = "Archived" if RETENTION_MODE == "archive" else "Deleted"
+    logging.info(f"{action} {len(removed)} old model versions ({freed} bytes), kept {len(keep)}.")
+    return {"versions": len(removed), "bytes": freed}
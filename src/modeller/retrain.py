@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import subprocess
+import tempfile
+
+from shards import BUFFER_DIR
+
+# Full retrain from every sample in the buffer, run by the leader. 0 turns it off.
+# The buffer is per replica, so it only runs while a single modeller replica is up.
+RETRAIN_INTERVAL_SECONDS = float(os.environ.get("RETRAIN_INTERVAL_SECONDS", str(24 * 60 * 60)))
+# Worker processes training data parallel on this machine, samples per worker per step.
+RETRAIN_WORKERS = int(os.environ.get("RETRAIN_WORKERS", "2"))
+RETRAIN_BATCH_SIZE = int(os.environ.get("RETRAIN_BATCH_SIZE", "32"))
+RETRAIN_EPOCHS = int(os.environ.get("RETRAIN_EPOCHS", "3"))
+RETRAIN_LEARNING_RATE = float(os.environ.get("RETRAIN_LEARNING_RATE", "0.0001"))
+# Seconds one run of the retrain workers may take before they are killed.
+RETRAIN_TIMEOUT_SECONDS = float(os.environ.get("RETRAIN_TIMEOUT_SECONDS", str(6 * 60 * 60)))
+# Steps run with 1..RETRAIN_WORKERS workers before a retrain to measure scaling, 0 skips it.
+RETRAIN_PROBE_STEPS = int(os.environ.get("RETRAIN_PROBE_STEPS", "10"))
+# Time of the last retrain and its throughput numbers, on the buffer volume so restarts remember them.
+RETRAIN_STATS_FILE = os.environ.get("RETRAIN_STATS_FILE", os.path.join(BUFFER_DIR, "retrain_stats.json"))
+
+def read_retrain_stats() -> dict:
+    try:
+        with open(RETRAIN_STATS_FILE) as stats_file:
+            return json.load(stats_file)
+    except FileNotFoundError:
+        return {}
+
+def write_retrain_stats(stats: dict):
+    with open(RETRAIN_STATS_FILE, "w") as stats_file:
+        json.dump(stats, stats_file)
+
+def retrain_due() -> bool:
+    if RETRAIN_INTERVAL_SECONDS <= 0:
+        return False
+    stats = read_retrain_stats()
+    if "finished_at" not in stats:
+        # first run on this volume, the interval starts now instead of retraining right after deploy.
+        write_retrain_stats({**stats, "finished_at": time.time()})
+        return False
+    # a failed retrain waits for the next interval too, it's not tried again every round.
+    last_attempt = max(stats["finished_at"], stats.get("failed_at", 0))
+    return time.time() - last_attempt >= RETRAIN_INTERVAL_SECONDS
+
+def record_failed_retrain():
+    write_retrain_stats({**read_retrain_stats(), "failed_at": time.time()})
+
+def free_ports(count: int) -> list:
+    sockets = []
+    for _ in range(count):
+        sock = socket.socket()
+        sock.bind(("localhost", 0))
+        sockets.append(sock)
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+def run_workers(model_path: str, shard_paths: list, workers: int, epochs: int = 1, steps: int | None = None, output_path: str | None = None) -> dict:
+    """
+    Trains the model with `workers` local processes under MultiWorkerMirroredStrategy
+    (TF_CONFIG cluster on localhost ports). Gradients are all-reduced every step,
+    so every worker ends with the same weights and the first one saves them to
+    output_path. Returns the timing the first worker measured.
+    When a worker fails or the run takes longer than RETRAIN_TIMEOUT_SECONDS the
+    remaining workers are killed, they would wait on each other forever.
+    """
+    workers = max(1, workers)
+    addresses = [f"localhost:{port}" for port in free_ports(workers)]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        spec_path = os.path.join(temp_dir, "spec.json")
+        stats_path = os.path.join(temp_dir, "stats.json")
+        with open(spec_path, "w") as spec_file:
+            json.dump({
+                "model": model_path,
+                "shards": shard_paths,
+                "epochs": epochs,
+                "steps": steps,
+                "output": output_path,
+                "stats": stats_path,
+            }, spec_file)
+
+        processes = []
+        for index in range(workers):
+            tf_config = {"cluster": {"worker": addresses}, "task": {"type": "worker", "index": index}}
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), spec_path],
+                env={**os.environ, "TF_CONFIG": json.dumps(tf_config)}
+            ))
+        deadline = time.monotonic() + RETRAIN_TIMEOUT_SECONDS
+        try:
+            while True:
+                return_codes = [process.poll() for process in processes]
+                if None not in return_codes or any(return_codes):
+                    break
+                if time.monotonic() >= deadline:
+                    raise RuntimeError(f"Retrain workers did not finish in {RETRAIN_TIMEOUT_SECONDS:.0f} s.")
+                time.sleep(1)
+        finally:
+            for process in processes:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+        return_codes = [process.returncode for process in processes]
+        if any(return_codes):
+            raise RuntimeError(f"Retrain workers failed with exit codes {return_codes}.")
+
+        with open(stats_path) as stats_file:
+            return json.load(stats_file)
+
+def measure_scaling(model_path: str, shard_paths: list, max_workers: int) -> dict:
+    """
+    Throughput with 1..max_workers workers for RETRAIN_PROBE_STEPS steps each.
+    efficiency is the throughput against n times the single worker one,
+    gain is what the last added worker brought, in single worker throughputs.
+    """
+    scaling = {}
+    previous = 0.0
+    single = None
+    for workers in range(1, max_workers + 1):
+        samples_per_second = run_workers(model_path, shard_paths, workers, steps=RETRAIN_PROBE_STEPS)["samples_per_second"]
+        single = single or samples_per_second
+        scaling[workers] = {
+            "samples_per_second": samples_per_second,
+            "efficiency": samples_per_second / (workers * single),
+            "gain": (samples_per_second - previous) / single,
+        }
+        previous = samples_per_second
+        logging.info(
+            f"Retrain with {workers} workers: {samples_per_second:.1f} samples/s, "
+            f"scaling efficiency {scaling[workers]['efficiency']:.2f}, added worker gain {scaling[workers]['gain']:.2f}."
+        )
+    return scaling
+
+def full_retrain(model_path: str, shards: list, output_path: str) -> dict:
+    """
+    Retrains the model on all the given shards with RETRAIN_WORKERS processes and
+    saves it to output_path. The scaling measurements and the run itself are
+    written to RETRAIN_STATS_FILE and returned.
+    """
+    shard_paths = [shard.path for shard in shards]
+    scaling = measure_scaling(model_path, shard_paths, RETRAIN_WORKERS) if RETRAIN_PROBE_STEPS > 0 else {}
+
+    started = time.time()
+    run = run_workers(model_path, shard_paths, RETRAIN_WORKERS, epochs=RETRAIN_EPOCHS, output_path=output_path)
+    stats = {
+        "finished_at": time.time(),
+        "workers": RETRAIN_WORKERS,
+        "samples": sum(len(shard) for shard in shards),
+        "seconds": time.time() - started,
+        "samples_per_second": run["samples_per_second"],
+        "scaling": scaling,
+    }
+    write_retrain_stats(stats)
+    logging.info(f"Full retrain on {stats['samples']} samples with {RETRAIN_WORKERS} workers took {stats['seconds']:.0f} s.")
+    return stats
+
+def worker_main(spec_path: str):
+    """One retrain worker process, started by run_workers()."""
+    import tensorflow as tf
+    import keras
+    from shards import Shard
+    from pipeline import training_dataset
+
+    with open(spec_path) as spec_file:
+        spec = json.load(spec_file)
+
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    workers = strategy.num_replicas_in_sync
+    global_batch_size = RETRAIN_BATCH_SIZE * workers
+    shards = [Shard.open(path) for path in spec["shards"]]
+
+    with strategy.scope():
+        model = keras.saving.load_model(spec["model"], compile=False)
+        optimizer = keras.optimizers.Adam(RETRAIN_LEARNING_RATE)
+        optimizer.build(model.trainable_variables)
+        loss_fn = keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction=None)
+
+    def dataset_fn(input_context):
+        # every worker streams its own part of the samples.
+        return training_dataset(
+            shards,
+            batch_size=input_context.get_per_replica_batch_size(global_batch_size),
+            worker_index=input_context.input_pipeline_id,
+            worker_count=input_context.num_input_pipelines
+        ).repeat()
+
+    iterator = iter(strategy.distribute_datasets_from_function(dataset_fn))
+
+    @tf.function
+    def train_step(iterator):
+        def step_fn(inputs):
+            images, labels = inputs
+            with tf.GradientTape() as tape:
+                logits = model(images, training=True)
+                loss = tf.nn.compute_average_loss(loss_fn(labels, logits), global_batch_size=global_batch_size)
+            gradients = tape.gradient(loss, model.trainable_variables)
+            optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+            return loss
+        return strategy.reduce(tf.distribute.ReduceOp.SUM, strategy.run(step_fn, args=(next(iterator),)), axis=None)
+
+    # the same number of steps on every worker, the all-reduce waits for all of them.
+    samples = sum(len(shard) for shard in shards)
+    steps_per_epoch = spec["steps"] or max(1, samples // global_batch_size)
+
+    # first step traces the function, it's not part of the measured time.
+    train_step(iterator)
+    started = time.time()
+    for epoch in range(spec["epochs"]):
+        for step in range(steps_per_epoch):
+            loss = train_step(iterator)
+        if spec["output"]:
+            logging.info(f"Retrain epoch {epoch + 1}/{spec['epochs']}, loss {float(loss):.4f}.")
+    seconds = time.time() - started
+
+    if strategy.cluster_resolver.task_id == 0:
+        if spec["output"]:
+            model.save(spec["output"])
+        with open(spec["stats"], "w") as stats_file:
+            json.dump({
+                "workers": workers,
+                "seconds": seconds,
+                "samples_per_second": spec["epochs"] * steps_per_epoch * global_batch_size / seconds,
+            }, stats_file)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    worker_main(sys.argv[1])
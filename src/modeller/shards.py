@@ -0,0 +1,174 @@
+import os
+import json
+import shutil
+import logging
+import time
+import numpy as np
+
+from preprocessing import IMAGE_SIZE
+
+# Local directory of the training buffer, should be on a volume that survives restarts.
+BUFFER_DIR = os.environ.get("BUFFER_DIR", "./buffer")
+# Byte budget of the buffer, oldest already trained shards are removed above it.
+BUFFER_MAX_BYTES = int(os.environ.get("BUFFER_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+IMAGES_FILE = "images.npy"
+LABELS_FILE = "labels.npy"
+COMMIT_FILE = "COMMIT"
+TRAINED_FILE = "TRAINED"
+
+class Shard:
+    """One committed shard: decoded images, their labels and where they came from."""
+    def __init__(self, path: str, meta: dict):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.meta = meta
+
+    @classmethod
+    def open(cls, path: str) -> "Shard":
+        """Reads a committed shard from its directory."""
+        with open(os.path.join(path, COMMIT_FILE)) as commit_file:
+            return cls(path, json.load(commit_file))
+
+    def __len__(self):
+        return self.meta["count"]
+
+    @property
+    def trained(self) -> bool:
+        return os.path.exists(os.path.join(self.path, TRAINED_FILE))
+
+    @property
+    def image_names(self) -> list:
+        return self.meta.get("image_names", [])
+
+    @property
+    def labeled_at(self) -> list:
+        """Unix times the samples were put into the queue."""
+        return self.meta.get("labeled_at", [])
+
+    def images(self) -> np.ndarray:
+        """(N, height, width, 3) uint8, memory mapped, pages are read only when used."""
+        return np.load(os.path.join(self.path, IMAGES_FILE), mmap_mode="r")
+
+    def labels(self) -> np.ndarray:
+        return np.load(os.path.join(self.path, LABELS_FILE))
+
+    def size_bytes(self) -> int:
+        return sum(entry.stat().st_size for entry in os.scandir(self.path) if entry.is_file())
+
+class ShardBuffer:
+    """
+    Append-only local buffer of preprocessed training samples.
+
+    Every ingested batch of labeled images becomes one shard directory holding a
+    fixed shape uint8 .npy array of the already resized images, the labels and a
+    COMMIT marker written last. Shards without the marker are leftovers of a
+    crash and are removed, so a committed shard is always complete. Queue
+    messages and source images are deleted only after the commit.
+
+    A shard is pending until a model trained on it is published, then it gets a
+    TRAINED marker and stays around (within BUFFER_MAX_BYTES) for replay.
+    """
+    def __init__(self, directory: str = BUFFER_DIR, max_bytes: int = BUFFER_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._remove_uncommitted()
+
+    def shards(self) -> list[Shard]:
+        """All committed shards, oldest first."""
+        shards = []
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if name.startswith("shard_") and os.path.exists(os.path.join(path, COMMIT_FILE)):
+                shards.append(Shard.open(path))
+        return shards
+
+    def pending_shards(self) -> list[Shard]:
+        return [shard for shard in self.shards() if not shard.trained]
+
+    def trained_shards(self) -> list[Shard]:
+        return [shard for shard in self.shards() if shard.trained]
+
+    def known_image_names(self) -> set:
+        """Source images already in the buffer, their messages only need deleting."""
+        return {name for shard in self.shards() for name in shard.image_names}
+
+    def append(self, images: list, labels: list, image_names: list, labeled_at: list) -> Shard | None:
+        """Writes the samples as a new shard and commits it. Returns None for an empty batch."""
+        if len(images) == 0:
+            return None
+
+        name = f"shard_{time.time_ns()}"
+        path = os.path.join(self.directory, name)
+        os.makedirs(path)
+
+        width, height = IMAGE_SIZE
+        image_array = np.lib.format.open_memmap(
+            os.path.join(path, IMAGES_FILE), mode="w+", dtype=np.uint8, shape=(len(images), height, width, 3)
+        )
+        for index, image in enumerate(images):
+            image_array[index] = image
+        image_array.flush()
+        del image_array
+        np.save(os.path.join(path, LABELS_FILE), np.asarray(labels, dtype=np.int32))
+        _fsync_files(path)
+
+        meta = {
+            "count": len(images),
+            "image_names": list(image_names),
+            "labeled_at": list(labeled_at),
+            "created_at": time.time(),
+        }
+        _write_durable(os.path.join(path, COMMIT_FILE), json.dumps(meta))
+        logging.info(f"Committed {name} with {len(images)} samples to the training buffer.")
+        return Shard(path, meta)
+
+    def mark_trained(self, shards: list[Shard]) -> None:
+        for shard in shards:
+            _write_durable(os.path.join(shard.path, TRAINED_FILE), str(time.time()))
+        self.evict()
+
+    def evict(self) -> None:
+        """Removes the oldest trained shards until the buffer fits in max_bytes. Pending shards are never removed."""
+        shards = self.shards()
+        total = sum(shard.size_bytes() for shard in shards)
+        for shard in shards:
+            if total <= self.max_bytes:
+                break
+            if not shard.trained:
+                continue
+            total -= shard.size_bytes()
+            shutil.rmtree(shard.path, ignore_errors=True)
+            logging.info(f"Training buffer evicted {shard.name}.")
+
+    def _remove_uncommitted(self):
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith("shard_") and os.path.isdir(path) and not os.path.exists(os.path.join(path, COMMIT_FILE)):
+                logging.warning(f"Removing uncommitted shard {name}.")
+                shutil.rmtree(path, ignore_errors=True)
+
+def _write_durable(path: str, content: str):
+    """Writes a small file through a temp file and rename, flushed to disk before returning."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as temp_file:
+        temp_file.write(content)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(temp_path, path)
+    _fsync_directory(os.path.dirname(path))
+
+def _fsync_files(directory: str):
+    for entry in os.scandir(directory):
+        if entry.is_file():
+            with open(entry.path, "rb") as data_file:
+                os.fsync(data_file.fileno())
+    _fsync_directory(directory)
+
+def _fsync_directory(directory: str):
+    file_descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
@@ -0,0 +1,92 @@
+import os
+import logging
+import time
+
+from datetime import datetime, timezone
+
+from utils import get_queue_service_client
+
+# Train as soon as this many labeled images wait in the queue...
+TRAIN_MIN_IMAGES = int(os.environ.get("TRAIN_MIN_IMAGES", "16"))
+# ...or when the oldest waiting image is this old (seconds), whatever comes first.
+TRAIN_MAX_AGE_SECONDS = float(os.environ.get("TRAIN_MAX_AGE_SECONDS", "300"))
+# Queue polling interval grows from min to max while the queue stays idle.
+POLL_MIN_SECONDS = float(os.environ.get("POLL_MIN_SECONDS", "1"))
+POLL_MAX_SECONDS = float(os.environ.get("POLL_MAX_SECONDS", "30"))
+
+class TrainingTrigger:
+    """
+    Decides when the next training cycle starts.
+
+    A cycle starts when TRAIN_MIN_IMAGES images are waiting or the oldest one has
+    waited TRAIN_MAX_AGE_SECONDS, so a single label is never stuck forever.
+    Only visible messages count, the queue's message count also has the ones
+    another replica (or a crashed cycle) holds until their visibility timeout.
+    Storage queues have no long polling, so an idle queue is polled with
+    exponential backoff, and while images wait the trigger sleeps exactly until
+    the oldest one reaches the age limit.
+    """
+    def __init__(self, min_images: int = TRAIN_MIN_IMAGES, max_age_seconds: float = TRAIN_MAX_AGE_SECONDS):
+        self.min_images = max(1, min_images)
+        self.max_age_seconds = max_age_seconds
+
+    def wait(self, max_wait_seconds: float | None = None) -> str | None:
+        """
+        Blocks until a cycle should run, returns the reason ("size" or "age").
+        Returns None if max_wait_seconds passed first.
+        """
+        deadline = time.monotonic() + max_wait_seconds if max_wait_seconds is not None else None
+        backoff = POLL_MIN_SECONDS
+        last_count = None
+        with get_queue_service_client() as queue_service_client:
+            queue = queue_service_client.get_queue_client(os.environ["STORAGE_QUEUE"])
+            while True:
+                count = queue.get_queue_properties().approximate_message_count
+                if count >= self.min_images and visible_messages(queue, self.min_images) >= min(self.min_images, 32):
+                    logging.info(f"{count} labeled images waiting, starting training.")
+                    return "size"
+
+                # new arrivals mean activity, poll quickly again.
+                if count != last_count:
+                    backoff = POLL_MIN_SECONDS
+                last_count = count
+
+                sleep_for = backoff
+                if count > 0:
+                    oldest = oldest_waiting_seconds(queue)
+                    if oldest is not None and oldest >= self.max_age_seconds:
+                        logging.info(f"Oldest of {count} labeled images waited {oldest:.0f} s, starting training.")
+                        return "age"
+                    if oldest is not None:
+                        sleep_for = min(backoff, self.max_age_seconds - oldest)
+
+                if deadline is not None:
+                    if time.monotonic() >= deadline:
+                        return None
+                    sleep_for = min(sleep_for, deadline - time.monotonic())
+                time.sleep(max(sleep_for, 0.1))
+                backoff = min(backoff * 2, POLL_MAX_SECONDS)
+
+def visible_messages(queue, limit: int) -> int:
+    """Visible messages at the front of the queue, at most limit (and at most 32, what one peek returns)."""
+    return len(list(queue.peek_messages(max_messages=max(1, min(limit, 32)))))
+
+def oldest_waiting_seconds(queue) -> float | None:
+    """Age of the message at the front of the queue, None if no message is visible."""
+    for message in queue.peek_messages(max_messages=1):
+        return (datetime.now(timezone.utc) - message.inserted_on).total_seconds()
+    return None
+
+def label_to_model_seconds(labeled_at: list) -> dict:
+    """
+    Time from labeling (unix time the message was inserted) to the new model
+    being available, for the samples trained into that model.
+    """
+    now = time.time()
+    waits = [now - timestamp for timestamp in labeled_at]
+    if not waits:
+        return {}
+    return {
+        "label_to_model_max_seconds": max(waits),
+        "label_to_model_avg_seconds": sum(waits) / len(waits),
+    }
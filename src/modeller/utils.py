@@ -1,10 +1,13 @@
 import os
+import re
+import socket
+import shutil
 import logging
 import zlib
 import numpy as np
 import pandas as pd
-from functools import lru_cache
 import json
+import tempfile
 import tensorflow as tf
 import keras
 from datetime import datetime
@@ -14,17 +17,57 @@ import zipfile
 from base64 import b64decode
 from io import StringIO, BytesIO
 from PIL import Image
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import BlobServiceClient, ContentSettings
 from azure.storage.queue import QueueServiceClient
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError, ResourceModifiedError
 from sklearn.linear_model import LogisticRegression
+from concurrent.futures import ThreadPoolExecutor
+from artifact_cache import artifact_cache
+from preprocessing import IMAGE_SIZE, decode_image, decode_batch
+from deltas import weight_delta, serialize_delta, deserialize_delta, delta_checksum, apply_delta
+
+# Keras 3 can read a .keras archive from a file object, older versions need a path.
+try:
+    from keras.src.saving import saving_lib
+    LOADS_FROM_MEMORY = hasattr(saving_lib, "_load_model_from_fileobj")
+except ImportError:
+    LOADS_FROM_MEMORY = False
 
 # Are we running in the cloud?
 CLOUD = os.environ.get("USE_AZURE_CREDENTIAL", "false").lower() == "true"
 
-def format_image(image):
-    image_res = 224
-    formated_image = tf.image.resize(image, (image_res, image_res))
-    return formated_image
+# Name of this modeller replica in logs and in the versions it publishes.
+REPLICA_NAME = os.environ.get("REPLICA_NAME", socket.gethostname())
+
+# Small json blob telling which model version is the newest one.
+MANIFEST_BLOB = "models/manifest.json"
+
+# Label index of each class, same order as in predictflower and flowerui.
+FLOWER_LIST = ["dandelion", "daisy", "tulips", "sunflowers", "roses"]
+
+# Zipped validation images and the local folder where they are kept decoded.
+VAL_BLOB = "datasets/val_data.zip"
+VAL_CACHE_DIR = os.environ.get("VAL_CACHE_DIR", "./val_cache")
+
+# Queue draining: messages taken per training cycle, parallel image downloads,
+# and how long (seconds) received messages stay hidden from other consumers.
+QUEUE_MAX_MESSAGES = int(os.environ.get("QUEUE_MAX_MESSAGES", "256"))
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "8"))
+QUEUE_VISIBILITY_TIMEOUT = int(os.environ.get("QUEUE_VISIBILITY_TIMEOUT", "600"))
+
+# Versions are published as weight deltas on top of their parent, at most this many
+# in a row before a full .keras file is published again. 0 publishes only full files.
+DELTA_MAX_CHAIN = int(os.environ.get("DELTA_MAX_CHAIN", "10"))
+
+# How many ranged GETs run at the same time when a model is downloaded.
+MODEL_DOWNLOAD_CONCURRENCY = int(os.environ.get("MODEL_DOWNLOAD_CONCURRENCY", "8"))
+
+# Post-training quantization of the TFLite model published next to every version:
+# "dynamic" (int8 weights), "int8" (weights and activations) or "off" (no TFLite export).
+TFLITE_QUANTIZATION = os.environ.get("TFLITE_QUANTIZATION", "dynamic").lower()
+# How many validation batches calibrate the int8 activation ranges.
+TFLITE_CALIBRATION_BATCHES = int(os.environ.get("TFLITE_CALIBRATION_BATCHES", "4"))
 
 def get_blob_service_client():
     """
@@ -61,113 +104,372 @@ def n_images_waiting() -> int:
         logging.info(f"Labeled images waiting in queue: {message_count}")
         return message_count
 
-def get_all_from_queue(): #-> list[tuple[image, int]]:
+def download_labeled_image(container_client, message) -> tuple | None:
+    """
+    Downloads and decodes the image of one queue message.
+    Returns (image, label), None if the image is missing or can't be decoded.
+    """
+    # https://stackoverflow.com/questions/39491420/python-jsonexpecting-property-name-enclosed-in-double-quotes?page=2&tab=scoredesc#tab-top
+    message_content = json.loads(message.content)
+    image_name = message_content.get("image_name")
+    label = message_content.get("label")
+    try:
+        download = container_client.get_blob_client(image_name).download_blob()
+        image_bytes = download.readall()
+        # images staged by predictflower from /predict/tensor are the raw uint8 model input.
+        if download.properties.metadata.get("format") == "rgb":
+            return np.frombuffer(image_bytes, dtype=np.uint8).reshape(IMAGE_SIZE[::-1] + (3,)), label
+        # decode straight to model input size, same preprocessing as predictflower
+        return decode_image(image_bytes), label
+    except (ResourceNotFoundError, OSError, ValueError):
+        logging.warning(f"Skipping {image_name}, image is missing or broken.")
+        return None
+
+def ingest_queue(buffer):
     """
-    checks queue for messages and loads image counterparts from blob_storage.
+    Moves waiting labeled images from storage into the local training buffer.
+
+    Receives up to QUEUE_MAX_MESSAGES messages in full pages and loads their images
+    from blob storage, INGEST_WORKERS downloads and decodes at a time, all through
+    one pooled blob client. The decoded images are committed as one shard and only
+    then the messages and images are deleted from storage. If we crash before the
+    commit the messages come back after QUEUE_VISIBILITY_TIMEOUT, if we crash after
+    it the images already in the buffer are not downloaded again.
+    Returns the new shard, None if nothing new was ingested.
     """
     logging.info("Getting all images from the queue.")
+    known_image_names = buffer.known_image_names()
 
-    with get_queue_service_client() as queue_service_client:
+    with get_queue_service_client() as queue_service_client, get_blob_service_client() as blob_service_client:
         queue = queue_service_client.get_queue_client(os.environ["STORAGE_QUEUE"])
-        messages = queue.receive_messages(messages_per_page=32)
-        new_rows = []
-
-        for msg in messages:
-            
-            # https://stackoverflow.com/questions/39491420/python-jsonexpecting-property-name-enclosed-in-double-quotes?page=2&tab=scoredesc#tab-top
-            message_content = json.loads(msg.content)
-            image_name = message_content.get("image_name")
-            label = message_content.get("label")
-            #logging.info(f"image_name: {image_name}")
-            #logging.info(f"label: {label}")
-            
-            # load images from blob storage.
-            with get_blob_service_client() as blob_service_client:
-                container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
-                blob_client = container_client.get_blob_client(image_name)
-                
-                blob_data = blob_client.download_blob()
-                bytes = blob_data.readall()
-                #logging.info(f"Bytes length: {len(bytes)}")
-                image = keras.preprocessing.image.load_img(BytesIO(bytes))
-
-                # format image to fit for training
-                image = format_image(image)
-                #logging.info(f"Image type: {type(image)}")
-
-                # delete blob
-                blob_client.delete_blob()
-            
-            # pair the image and label to training data list
-            new_rows.append((image, label))
-            # delete message from queue
-            queue.delete_message(msg)
-
-        logging.info(f"Got {len(new_rows)} images from the queue.")
-        return new_rows
-
-def latest_model_version() -> int:
-    """
-    returns the value of latest saved model from blob storage
-    used to load newest model for prediction.
+        container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
+
+        messages = list(queue.receive_messages(
+            messages_per_page=32, # maximum the queue service gives in one call
+            max_messages=QUEUE_MAX_MESSAGES,
+            visibility_timeout=QUEUE_VISIBILITY_TIMEOUT
+        ))
+        new_messages = [message for message in messages if json.loads(message.content).get("image_name") not in known_image_names]
+
+        with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as executor:
+            results = list(executor.map(lambda message: download_labeled_image(container_client, message), new_messages))
+
+    rows = [(message, row) for message, row in zip(new_messages, results) if row is not None]
+    logging.info(f"Got {len(rows)} new images from {len(messages)} queue messages.")
+
+    shard = buffer.append(
+        images=[row[0] for _, row in rows],
+        labels=[row[1] for _, row in rows],
+        image_names=[json.loads(message.content).get("image_name") for message, _ in rows],
+        labeled_at=[message.inserted_on.timestamp() for message, _ in rows],
+    )
+    # safe in the buffer (or missing/broken), storage copies are not needed anymore.
+    delete_from_queue(messages)
+    return shard
+
+def delete_from_queue(messages: list):
+    """
+    Deletes ingested messages and their images. Images are deleted with batch
+    requests, messages (no batch API for queues) in parallel.
+    """
+    if not messages:
+        return
+    image_names = [json.loads(message.content).get("image_name") for message in messages]
+
+    with get_queue_service_client() as queue_service_client, get_blob_service_client() as blob_service_client:
+        queue = queue_service_client.get_queue_client(os.environ["STORAGE_QUEUE"])
+        container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
+
+        # one batch request can hold at most 256 deletes.
+        for start in range(0, len(image_names), 256):
+            container_client.delete_blobs(*image_names[start:start + 256], raise_on_any_failure=False)
+
+        with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as executor:
+            list(executor.map(queue.delete_message, messages))
+
+    logging.info(f"Deleted {len(messages)} used messages and images.")
+
+def scan_latest_version(container_client) -> int:
+    """
+    Finds the newest model by listing all the model blobs.
+    Only used when the manifest does not exist yet.
+    """
+    blobs = container_client.list_blobs(name_starts_with="models/flowersmodel_")
+    return max([int(x.name.split("_")[1].split(".")[0]) for x in blobs if x.name.endswith(".keras")])
+
+class ManifestConflict(Exception):
+    """Another replica published a new version after ours was started."""
+
+def read_manifest() -> tuple[dict | None, str | None]:
+    """
+    returns the published model manifest and its ETag, (None, None) if it's not published yet.
     """
     with get_blob_service_client() as blob_service_client:
         container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
-        blobs = container_client.list_blobs(name_starts_with="models/")
+        try:
+            downloader = container_client.get_blob_client(MANIFEST_BLOB).download_blob()
+        except ResourceNotFoundError:
+            return None, None
+        return json.loads(downloader.readall()), downloader.properties.etag
 
-        latest = max([int(x.name.split("_")[1].split(".")[0]) for x in blobs])
+def version_record_blob(version: int) -> str:
+    """Every published version also has its manifest entry stored next to its files."""
+    return f"models/flowersmodel_{version}.json"
 
-        unix_to_iso = datetime.fromtimestamp(latest).isoformat()
-        logging.info(f"Latest_model_version() seeing: {latest} created at {unix_to_iso}")
-        return latest
-    
-@lru_cache(maxsize=5)
-def load_model(version:int):
-    # Find the latest model from /models folder in the storage container
-    # The model name follows the pattern model_{unix_seconds}.keras
+def read_version_record(version: int) -> dict:
+    """
+    The manifest entry a version was published with.
+    Versions from before records existed are full .keras files.
+    """
     with get_blob_service_client() as blob_service_client:
         container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
-        blob_client = container_client.get_blob_client(f"models/flowersmodel_{version}.keras") 
-        logging.info(f"Loading model version {version}.")
-        #logging.info(f"type {type(blob_client)}.")
-
-        blob_data = blob_client.download_blob()
-        file_bytes = blob_data.readall()
-        #logging.info(f"Downloaded model size: {len(file_bytes)} bytes.")
-        #logging.info(f"type {type(file_bytes)}.")
-        return file_bytes
-
-        # https://stackoverflow.com/questions/74693871/why-joblib-is-not-recommended-when-saving-keras-model
-        # with BytesIO() as data:
-        #     logging.info(f"1")
-        #     logging.info(f"{data}")
-        #     blob_client.download_blob().readinto(data)
-        #     logging.info(f"{data}")
-        #     logging.info(f"2")
-        #     return joblib.load(data)
-
-def load_dataset():
-    """
-    unzips the data.
-    """
-    logging.info(f"Loading validation dataset.")
+        try:
+            return json.loads(container_client.get_blob_client(version_record_blob(version)).download_blob().readall())
+        except ResourceNotFoundError:
+            return {"version": version, "artifact": "full", "blob": f"models/flowersmodel_{version}.keras", "base": version, "chain_length": 0}
+
+def publish_manifest(
+    version: int,
+    artifact: dict,
+    metrics: dict | None = None,
+    tflite: dict | None = None,
+    parent: int | None = None,
+    expected_etag: str | None = None
+) -> dict:
+    """
+    Points the manifest to the given model version.
+    predictflower reads this instead of listing the models/ folder.
+    artifact describes the model file of the version (see publish_model_artifact),
+    tflite the quantized TFLite artifact, if one was exported.
+
+    Publishing is optimistic: the manifest is only replaced if it still has
+    expected_etag (the manifest the parent version was read from), without it only
+    a missing manifest is created. Raises ManifestConflict when another replica
+    was faster, the caller trains again on top of the new version. The version
+    record is never replaced, another replica that published the same version
+    number with other files is a conflict too.
+    """
+    manifest = {
+        "version": version,
+        **artifact,
+        "parent": parent,
+        "trained_by": REPLICA_NAME,
+        "metrics": {name: float(value) for name, value in (metrics or {}).items()},
+        "created_at": datetime.now().isoformat(),
+    }
+    if tflite is not None:
+        manifest["tflite"] = tflite
+
+    if expected_etag is not None:
+        condition = {"etag": expected_etag, "match_condition": MatchConditions.IfNotModified}
+    else:
+        condition = {"match_condition": MatchConditions.IfMissing}
     with get_blob_service_client() as blob_service_client:
         container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
-        blob_client = container_client.get_blob_client("datasets/val_data.zip")
+        # the record first, the manifest must never point to a version without one.
+        record_client = container_client.get_blob_client(version_record_blob(version))
+        try:
+            record = record_client.upload_blob(
+                json.dumps(manifest),
+                overwrite=False,
+                content_settings=ContentSettings(content_type="application/json")
+            )
+        except ResourceExistsError as error:
+            # fine when it describes these same files (bootstrap of a version with a record).
+            existing = json.loads(record_client.download_blob().readall())
+            if (existing.get("blob"), existing.get("etag")) != (artifact["blob"], artifact["etag"]):
+                raise ManifestConflict(f"Another replica published version {version}.") from error
+            record = None
+        try:
+            container_client.get_blob_client(MANIFEST_BLOB).upload_blob(
+                json.dumps(manifest),
+                overwrite=True,
+                content_settings=ContentSettings(content_type="application/json"),
+                **condition
+            )
+        except (ResourceModifiedError, ResourceExistsError) as error:
+            if record is not None:
+                # only our own record, in case someone else published the version meanwhile.
+                try:
+                    record_client.delete_blob(etag=record["etag"], match_condition=MatchConditions.IfNotModified)
+                except (ResourceNotFoundError, ResourceModifiedError):
+                    pass
+            raise ManifestConflict(f"Manifest changed, version {version} was not published.") from error
+    logging.info(f"Manifest now points to model version {version} (parent {parent}, {artifact['artifact']} artifact).")
+    return manifest
 
-        os.makedirs("./val/", exist_ok=True)
-        target_folder = pathlib.Path("./val/")
-        blob_stream = blob_client.download_blob()
-        zip_data = blob_stream.readall()
+def latest_manifest(bootstrap: bool = True) -> tuple[dict | None, str | None]:
+    """
+    returns the latest manifest and its ETag.
+    If there's no manifest yet (fresh storage) and bootstrap is set, models are
+    scanned once and the manifest is published. Only the leader replica bootstraps,
+    the others get (None, None) until it's done.
+    """
+    manifest, manifest_etag = read_manifest()
+    if manifest is None and bootstrap:
+        with get_blob_service_client() as blob_service_client:
+            container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
+            latest = scan_latest_version(container_client)
+            properties = container_client.get_blob_client(f"models/flowersmodel_{latest}.keras").get_blob_properties()
+        artifact = {
+            "artifact": "full",
+            "blob": f"models/flowersmodel_{latest}.keras",
+            "etag": properties.etag,
+            "size": properties.size,
+            "base": latest,
+            "chain_length": 0,
+        }
+        try:
+            publish_manifest(latest, artifact)
+        except ManifestConflict:
+            pass
+        manifest, manifest_etag = read_manifest()
 
-        with zipfile.ZipFile(BytesIO(zip_data), mode="r") as archive:
-            archive.extractall(target_folder)
+    if manifest is not None:
+        unix_to_iso = datetime.fromtimestamp(manifest["version"]).isoformat()
+        logging.info(f"latest_manifest() seeing: {manifest['version']} created at {unix_to_iso}")
+    return manifest, manifest_etag
 
-        return None
+def delete_version_blobs(version: int, uploaded: list):
+    """
+    Removes the files we uploaded for a version that never made it into the manifest.
+    Only the given {"blob", "etag"} entries are deleted, and only if nobody replaced
+    them, another replica may have published the same version number.
+    """
+    if not uploaded:
+        return
+    with get_blob_service_client() as blob_service_client:
+        container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
+        container_client.delete_blobs(
+            *[
+                {"name": entry["blob"], "etag": entry["etag"], "match_condition": MatchConditions.IfNotModified}
+                for entry in uploaded
+            ],
+            raise_on_any_failure=False
+        )
+    logging.info(f"Deleted unpublished files of model version {version}.")
+
+def deserialize_model(model_bytes):
+    """.keras bytes into a keras model, without touching the disk when keras allows it."""
+    if LOADS_FROM_MEMORY:
+        return saving_lib.load_model(BytesIO(model_bytes))
+
+    # keras wants a path, the temp file is removed right after loading.
+    with tempfile.NamedTemporaryFile(suffix=".keras") as temp_file:
+        temp_file.write(model_bytes)
+        temp_file.flush()
+        return tf.keras.models.load_model(temp_file.name)
+
+def download_artifact(blob_name: str) -> bytes:
+    """
+    Model file bytes from the local artifact cache, or a parallel ranged download
+    pinned to the blob's ETag when it's not cached yet.
+    """
+    with get_blob_service_client() as blob_service_client:
+        container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
+        blob_client = container_client.get_blob_client(blob_name)
+
+        # local disk cache first, keyed by the ETag so an overwritten blob is fetched again.
+        properties = blob_client.get_blob_properties()
+        file_bytes = artifact_cache.get(blob_name, properties.etag)
+        if file_bytes is None:
+            blob_data = blob_client.download_blob(
+                max_concurrency=MODEL_DOWNLOAD_CONCURRENCY,
+                etag=properties.etag,
+                match_condition=MatchConditions.IfNotModified
+            )
+            file_bytes = blob_data.readall()
+            artifact_cache.put(blob_name, properties.etag, file_bytes)
+    return file_bytes
+
+def load_model(version:int, record: dict | None = None):
+    """
+    Loads model version as a keras model.
+    A delta version is built from the full file at the start of its chain with
+    the deltas of the versions in between applied in order.
+    """
+    record = record or read_version_record(version)
+    chain = []
+    while record.get("artifact", "full") == "delta":
+        chain.append(record)
+        record = read_version_record(record["parent"])
+    logging.info(f"Loading model version {version} from {record['blob']} and {len(chain)} deltas.")
+
+    file_bytes = download_artifact(record["blob"])
+    model = deserialize_model(file_bytes)
+    del file_bytes
+    for delta_record in reversed(chain):
+        apply_delta(model, deserialize_delta(download_artifact(delta_record["blob"]), delta_record["sha256"]))
+    return model
+
+def load_validation_cache(directory: str = VAL_CACHE_DIR) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Validation images (N, 224, 224, 3) uint8 and their labels, memory mapped.
+
+    The set is decoded once from datasets/val_data.zip with the shared preprocessing
+    and saved under a folder named by the zip's ETag, so restarts and training
+    cycles reuse it and only a changed zip is downloaded and decoded again.
+    Class folders in the zip are mapped to labels through FLOWER_LIST.
+    """
+    with get_blob_service_client() as blob_service_client:
+        container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
+        blob_client = container_client.get_blob_client(VAL_BLOB)
+        etag = blob_client.get_blob_properties().etag
+
+        os.makedirs(directory, exist_ok=True)
+        cache_path = os.path.join(directory, f"val-{re.sub('[^0-9A-Za-z]', '', etag)}")
+        if not os.path.exists(os.path.join(cache_path, "COMMIT")):
+            logging.info(f"Loading validation dataset.")
+            zip_data = blob_client.download_blob(etag=etag, match_condition=MatchConditions.IfNotModified).readall()
+            images, labels = decode_validation_zip(zip_data)
+            save_validation_cache(cache_path, images, labels)
+
+    # older versions of the set are not needed anymore.
+    for name in os.listdir(directory):
+        if name.startswith("val-") and os.path.join(directory, name) != cache_path:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+    images = np.load(os.path.join(cache_path, "images.npy"), mmap_mode="r")
+    labels = np.load(os.path.join(cache_path, "labels.npy"))
+    logging.info(f"Loaded {len(labels)} validation images.")
+    return images, labels
 
-def upload_model(model_file, file_path):
+def decode_validation_zip(zip_data: bytes) -> tuple[np.ndarray, np.ndarray]:
+    """Decodes the images of the zip straight from memory, nothing is extracted to disk."""
+    image_bytes = []
+    labels = []
+    with zipfile.ZipFile(BytesIO(zip_data), mode="r") as archive:
+        for name in sorted(archive.namelist()):
+            path = pathlib.PurePosixPath(name)
+            if path.suffix.lower() not in (".jpg", ".jpeg", ".png", ".bmp", ".gif"):
+                continue
+            if path.parent.name not in FLOWER_LIST:
+                logging.warning(f"Skipping {name}, unknown class folder.")
+                continue
+            image_bytes.append(archive.read(name))
+            labels.append(FLOWER_LIST.index(path.parent.name))
+
+    with ThreadPoolExecutor() as executor:
+        images = decode_batch(image_bytes, executor)
+    return images, np.array(labels, dtype=np.int32)
+
+def save_validation_cache(cache_path: str, images: np.ndarray, labels: np.ndarray):
+    """Writes the arrays into a temp folder that is renamed into place, a crash never leaves half a cache."""
+    temp_path = f"{cache_path}.tmp"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    np.save(os.path.join(temp_path, "images.npy"), images)
+    np.save(os.path.join(temp_path, "labels.npy"), labels)
+    with open(os.path.join(temp_path, "COMMIT"), "w") as commit_file:
+        commit_file.write(str(len(labels)))
+    shutil.rmtree(cache_path, ignore_errors=True)
+    os.replace(temp_path, cache_path)
+
+def upload_model(model_file, file_path, overwrite: bool = True) -> dict:
     """
     Append new model to models.
+    Returns etag and size of the uploaded blob for the manifest.
+    With overwrite=False an existing blob raises ResourceExistsError, version files are never replaced.
     """
     logging.info(f"Uploading model {file_path} to storage container.")
     #logging.info(f"model_file: {model_file}")
@@ -176,9 +478,110 @@ def upload_model(model_file, file_path):
         container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
         with open(model_file, "rb") as data:
             blob_client = container_client.get_blob_client(file_path)
-            blob_client.upload_blob(data, overwrite=True)
+            result = blob_client.upload_blob(data, overwrite=overwrite)
             logging.info(f"Upload complete for {model_file}.")
 
+    # predictflower on the same node can now load the new version from disk.
+    with open(model_file, "rb") as data:
+        artifact_cache.put(file_path, result["etag"], data.read())
+    return {"etag": result["etag"], "size": os.path.getsize(model_file)}
+
+def publish_model_artifact(model, version: int, parent_weights: list | None, parent_record: dict) -> dict:
+    """
+    Uploads the model file of a new version and returns its manifest fields.
+
+    When parent_weights are given and the parent's delta chain is shorter than
+    DELTA_MAX_CHAIN, only the layers that changed from the parent are uploaded
+    as a compressed npz with its sha256, otherwise the full .keras file.
+    """
+    chain_length = parent_record.get("chain_length", 0)
+    if parent_weights is not None and 0 < DELTA_MAX_CHAIN and chain_length < DELTA_MAX_CHAIN:
+        delta_bytes = serialize_delta(weight_delta(parent_weights, model), model)
+        with open("temp_model.delta.npz", "wb") as delta_file:
+            delta_file.write(delta_bytes)
+        uploaded = upload_model("temp_model.delta.npz", f"models/flowersmodel_{version}.delta.npz", overwrite=False)
+        logging.info(f"Published version {version} as a {uploaded['size']} byte delta.")
+        return {
+            "artifact": "delta",
+            "blob": f"models/flowersmodel_{version}.delta.npz",
+            "etag": uploaded["etag"],
+            "size": uploaded["size"],
+            "sha256": delta_checksum(delta_bytes),
+            "base": parent_record.get("base", parent_record["version"]),
+            "chain_length": chain_length + 1,
+        }
+
+    model.save("temp_model.keras")
+    uploaded = upload_model("temp_model.keras", f"models/flowersmodel_{version}.keras", overwrite=False)
+    return {
+        "artifact": "full",
+        "blob": f"models/flowersmodel_{version}.keras",
+        "etag": uploaded["etag"],
+        "size": uploaded["size"],
+        "base": version,
+        "chain_length": 0,
+    }
+
+def export_tflite(model, calibration_batches) -> bytes:
+    """
+    Converts the keras model into a post-training quantized TFLite model.
+    Inputs and outputs stay float32, so the serving code is the same as with keras.
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if TFLITE_QUANTIZATION == "int8":
+        def representative_dataset():
+            for images, _ in calibration_batches.take(TFLITE_CALIBRATION_BATCHES):
+                for image in images:
+                    yield [tf.expand_dims(image, axis=0)]
+        converter.representative_dataset = representative_dataset
+
+    return converter.convert()
+
+def evaluate_tflite(tflite_model: bytes, batches) -> float:
+    """Accuracy of the TFLite model on the given (images, labels) batches."""
+    interpreter = tf.lite.Interpreter(model_content=tflite_model)
+    input_index = interpreter.get_input_details()[0]["index"]
+    output_index = interpreter.get_output_details()[0]["index"]
+
+    correct = 0
+    total = 0
+    for images, labels in batches:
+        interpreter.resize_tensor_input(input_index, images.shape)
+        interpreter.allocate_tensors()
+        interpreter.set_tensor(input_index, images.numpy().astype(np.float32))
+        interpreter.invoke()
+        predicted = np.argmax(interpreter.get_tensor(output_index), axis=1)
+        correct += int(np.sum(predicted == labels.numpy()))
+        total += len(predicted)
+    return correct / max(total, 1)
+
+def publish_tflite(model, version: int, val_batches) -> dict | None:
+    """
+    Exports, evaluates and uploads the TFLite model of a version.
+    Returns the manifest entry for it, None when TFLite export is off.
+    """
+    if TFLITE_QUANTIZATION == "off":
+        return None
+
+    tflite_model = export_tflite(model, val_batches)
+    accuracy = evaluate_tflite(tflite_model, val_batches)
+    logging.info(f"TFLite ({TFLITE_QUANTIZATION}) model is {len(tflite_model)} bytes, validation accuracy {accuracy:.3f}.")
+
+    with open("temp_model.tflite", "wb") as tflite_file:
+        tflite_file.write(tflite_model)
+    blob_name = f"models/flowersmodel_{version}.tflite"
+    uploaded = upload_model("temp_model.tflite", blob_name, overwrite=False)
+
+    return {
+        "blob": blob_name,
+        "etag": uploaded["etag"],
+        "size": uploaded["size"],
+        "quantization": TFLITE_QUANTIZATION,
+        "accuracy": accuracy,
+    }
+
 ### UNUSED
 
 def upload(csv_data:str, file_path:str):
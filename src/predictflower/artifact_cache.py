@@ -0,0 +1,91 @@
+import os
+import re
+import logging
+import tempfile
+
+from typing import Optional
+
+# Local directory for downloaded model files, shared by every process on the node
+# that mounts it. Empty value turns the cache off.
+ARTIFACT_CACHE_DIR = os.environ.get("ARTIFACT_CACHE_DIR", "./artifact_cache")
+# Byte budget of the cache, least recently used files are removed above it.
+ARTIFACT_CACHE_BYTES = int(os.environ.get("ARTIFACT_CACHE_BYTES", str(1024 * 1024 * 1024)))
+
+class ArtifactCache:
+    """
+    Size bounded LRU cache of model files on local disk.
+
+    Files are keyed by blob name and ETag, so a blob that is overwritten in
+    storage is never served from an old copy. Writes go to a temp file that is
+    renamed into place, readers never see half written files even when several
+    services share the directory. File mtime is the LRU clock.
+    """
+    def __init__(self, directory: str = ARTIFACT_CACHE_DIR, max_bytes: int = ARTIFACT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def path_for(self, name: str, etag: str) -> str:
+        stem, suffix = os.path.splitext(os.path.basename(name))
+        return os.path.join(self.directory, f"{stem}-{re.sub('[^0-9A-Za-z]', '', etag)}{suffix}")
+
+    def get(self, name: str, etag: str) -> Optional[bytes]:
+        """Cached file contents, None on a miss."""
+        if not self.enabled:
+            return None
+        path = self.path_for(name, etag)
+        try:
+            with open(path, "rb") as cached:
+                data = cached.read()
+        except FileNotFoundError:
+            return None
+
+        # mark as recently used.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        logging.info(f"Artifact cache hit for {name}.")
+        return data
+
+    def put(self, name: str, etag: str, data) -> None:
+        if not self.enabled:
+            return
+        path = self.path_for(name, etag)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, "wb") as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self.evict(keep=path)
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Removes least recently used files until the cache fits in max_bytes."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                logging.info(f"Artifact cache evicted {os.path.basename(path)}.")
+            except FileNotFoundError:
+                pass
+            total -= size
+
+artifact_cache = ArtifactCache()
@@ -0,0 +1,210 @@
+import os
+import io
+import queue
+import tempfile
+import numpy as np
+import tensorflow as tf
+
+from abc import ABC, abstractmethod
+from deltas import apply_delta
+from preprocessing import IMAGE_SIZE, normalize
+
+# Which artifact serves predictions: "keras" (.keras file) or "tflite" (quantized .tflite file).
+PREDICT_BACKEND = os.environ.get("PREDICT_BACKEND", "keras").lower()
+# TFLite interpreters kept ready, one is needed per concurrent model call.
+TFLITE_POOL_SIZE = int(os.environ.get("TFLITE_POOL_SIZE", os.environ.get("INFERENCE_WORKERS", "1")))
+# Threads each TFLite interpreter may use inside one call.
+TFLITE_THREADS = int(os.environ.get("TFLITE_THREADS", "1"))
+# Batch sizes with a prepared serving function, other batches are padded up to the next one.
+SERVING_BATCH_BUCKETS = os.environ.get("SERVING_BATCH_BUCKETS", "1,2,4,8,16,32")
+# XLA compile the keras serving functions.
+SERVING_XLA = os.environ.get("SERVING_XLA", "false").lower() == "true"
+
+INPUT_SHAPE = IMAGE_SIZE[::-1] + (3,)
+
+# Keras 3 can read a .keras archive from a file object, older versions need a path.
+try:
+    from keras.src.saving import saving_lib
+    LOADS_FROM_MEMORY = hasattr(saving_lib, "_load_model_from_fileobj")
+except ImportError:
+    LOADS_FROM_MEMORY = False
+
+def deserialize_model(model_bytes):
+    """.keras bytes into a keras model, without touching the disk when keras allows it."""
+    if LOADS_FROM_MEMORY:
+        return saving_lib.load_model(io.BytesIO(model_bytes))
+
+    # keras wants a path, the temp file is removed right after loading.
+    with tempfile.NamedTemporaryFile(suffix=".keras") as temp_file:
+        temp_file.write(model_bytes)
+        temp_file.flush()
+        return tf.keras.models.load_model(temp_file.name)
+
+def batch_buckets() -> list:
+    """Batch sizes the serving functions are built for, sorted."""
+    return sorted({int(size) for size in SERVING_BATCH_BUCKETS.split(",") if size.strip()})
+
+def bucket_for(size: int, buckets: list) -> int:
+    """Smallest bucket the batch fits in, the largest one for bigger batches (they are split)."""
+    for bucket in buckets:
+        if size <= bucket:
+            return bucket
+    return buckets[-1]
+
+def pad_to(batch: np.ndarray, size: int) -> np.ndarray:
+    """Batch padded with black images up to size rows."""
+    if len(batch) == size:
+        return batch
+    padding = np.zeros((size - len(batch),) + batch.shape[1:], dtype=batch.dtype)
+    return np.concatenate([batch, padding])
+
+class BucketedBackend(ABC):
+    """
+    Shared batching of the backends: a batch of uint8 images is split into chunks
+    of at most the largest bucket, each chunk is padded to the next bucket size and
+    run through _run_bucket(), which returns (probabilities, labels).
+    Only the bucket shapes ever reach the model, so nothing is traced or
+    reallocated while serving.
+    """
+    def __init__(self):
+        self.buckets = batch_buckets()
+
+    def predict(self, batch) -> tuple:
+        """softmax probabilities and predicted labels for a batch of decoded uint8 images."""
+        batch = np.asarray(batch, dtype=np.uint8)
+        probabilities = []
+        labels = []
+        for start in range(0, len(batch), self.buckets[-1]):
+            chunk = batch[start:start + self.buckets[-1]]
+            chunk_probabilities, chunk_labels = self._run_bucket(pad_to(chunk, bucket_for(len(chunk), self.buckets)))
+            probabilities.append(chunk_probabilities[:len(chunk)])
+            labels.append(chunk_labels[:len(chunk)])
+        return np.concatenate(probabilities), np.concatenate(labels)
+
+    def warmup(self):
+        """Runs every bucket once, the first real request after a version swap pays no setup cost."""
+        for bucket in self.buckets:
+            self._run_bucket(np.zeros((bucket,) + INPUT_SHAPE, dtype=np.uint8))
+
+    @abstractmethod
+    def _run_bucket(self, batch) -> tuple:
+        """(probabilities, labels) of a batch padded to one of the buckets."""
+
+    @abstractmethod
+    def memory_bytes(self) -> int:
+        """Rough RAM taken by the loaded model, used for the model pool budget."""
+
+class KerasBackend(BucketedBackend):
+    """
+    Serves predictions with the full keras model through compiled tf.functions.
+
+    There is one concrete function per bucket batch size with a fixed input
+    signature. Normalizing, the model, softmax and argmax all run in the graph,
+    optionally XLA compiled (SERVING_XLA). model.predict is not used, its data
+    adapter, callbacks and step loop cost more than the forward pass of a few images.
+    """
+    name = "keras"
+
+    def __init__(self, model_bytes=None, model=None):
+        super().__init__()
+        self.model = model if model is not None else deserialize_model(model_bytes)
+        serve = tf.function(self._serve, jit_compile=SERVING_XLA)
+        self._functions = {
+            bucket: serve.get_concrete_function(tf.TensorSpec((bucket,) + INPUT_SHAPE, tf.uint8))
+            for bucket in self.buckets
+        }
+
+    def _serve(self, images):
+        logits = self.model(normalize(images), training=False)
+        probabilities = tf.nn.softmax(logits)
+        return probabilities, tf.argmax(probabilities, axis=-1, output_type=tf.int32)
+
+    def _run_bucket(self, batch) -> tuple:
+        probabilities, labels = self._functions[len(batch)](tf.constant(batch))
+        return probabilities.numpy(), labels.numpy()
+
+    def memory_bytes(self) -> int:
+        # the weights, the traced functions are small next to them.
+        return sum(int(np.prod(weight.shape)) * np.dtype(weight.dtype).itemsize for weight in self.model.weights)
+
+    def with_deltas(self, deltas: list) -> "KerasBackend":
+        """
+        New backend with a copy of this model and the weight deltas (oldest first)
+        applied. This one is not touched, it can keep serving meanwhile.
+        """
+        model = tf.keras.models.clone_model(self.model)
+        model.set_weights(self.model.get_weights())
+        for entries in deltas:
+            apply_delta(model, entries)
+        return KerasBackend(model=model)
+
+class TFLiteBackend(BucketedBackend):
+    """
+    Serves predictions with the quantized TFLite model.
+
+    One interpreter can't run two calls at the same time, so a small pool of them
+    is kept. All interpreters read the same model buffer. Batches are padded to
+    the bucket sizes, so an interpreter reallocates tensors only the first time
+    it sees a bucket. Softmax and argmax run in numpy, the graph comes from the
+    modeller as is.
+    """
+    name = "tflite"
+
+    def __init__(self, model_bytes, pool_size: int = TFLITE_POOL_SIZE):
+        super().__init__()
+        self._model_content = bytes(model_bytes)
+        self._pool_size = max(1, pool_size)
+        self._pool = queue.Queue()
+        for _ in range(self._pool_size):
+            interpreter = tf.lite.Interpreter(model_content=self._model_content, num_threads=TFLITE_THREADS)
+            interpreter.allocate_tensors()
+            self._pool.put(interpreter)
+
+    def warmup(self):
+        # every interpreter allocates every bucket once.
+        interpreters = [self._pool.get() for _ in range(self._pool.qsize())]
+        try:
+            for interpreter in interpreters:
+                for bucket in self.buckets:
+                    self._invoke(interpreter, np.zeros((bucket,) + INPUT_SHAPE, dtype=np.float32))
+        finally:
+            for interpreter in interpreters:
+                self._pool.put(interpreter)
+
+    def memory_bytes(self) -> int:
+        # the shared model buffer and the tensors of every interpreter at the largest bucket.
+        interpreter = self._pool.get()
+        try:
+            tensors = sum(
+                int(np.prod(detail["shape"])) * np.dtype(detail["dtype"]).itemsize
+                for detail in interpreter.get_tensor_details()
+            )
+        finally:
+            self._pool.put(interpreter)
+        return len(self._model_content) + tensors * self._pool_size
+
+    def _run_bucket(self, batch) -> tuple:
+        interpreter = self._pool.get()
+        try:
+            # same values as normalize(), in numpy, so this backend never starts the TF runtime
+            # and can be loaded before the workers are forked (serve.py).
+            logits = self._invoke(interpreter, batch.astype(np.float32) / np.float32(255.0))
+        finally:
+            self._pool.put(interpreter)
+        exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+        probabilities = exp / exp.sum(axis=-1, keepdims=True)
+        return probabilities, np.argmax(probabilities, axis=-1)
+
+    def _invoke(self, interpreter, batch) -> np.ndarray:
+        input_detail = interpreter.get_input_details()[0]
+        if tuple(input_detail["shape"]) != tuple(batch.shape):
+            interpreter.resize_tensor_input(input_detail["index"], batch.shape)
+            interpreter.allocate_tensors()
+        interpreter.set_tensor(input_detail["index"], batch)
+        interpreter.invoke()
+        return interpreter.get_tensor(interpreter.get_output_details()[0]["index"]).copy()
+
+def build_backend(name: str, model_bytes):
+    if name == "tflite":
+        return TFLiteBackend(model_bytes)
+    return KerasBackend(model_bytes)
@@ -0,0 +1,144 @@
+import os
+import logging
+import queue
+import threading
+import time
+import numpy as np
+
+from concurrent.futures import Future
+
+# Micro-batching window: at most this many images per model call,
+# and the first waiting image waits at most this many milliseconds for company.
+MICROBATCH_MAX_SIZE = int(os.environ.get("MICROBATCH_MAX_SIZE", "16"))
+MICROBATCH_MAX_WAIT_MS = float(os.environ.get("MICROBATCH_MAX_WAIT_MS", "5"))
+
+class _Request:
+    def __init__(self, image, served):
+        self.image = image
+        self.served = served # (version, model) the caller got from the holder
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+class BatchScheduler:
+    """
+    Collects single image predictions arriving close together into one model call.
+
+    The first request in the queue opens a window of max_wait_ms, requests coming
+    inside it (up to max_batch_size) are predicted in the same forward pass and
+    each caller gets its own row of the output through a Future.
+    predict_fn(model, batch) must return softmax probabilities for the batch.
+
+    Batches run in the given executor. While all of its workers are busy the
+    scheduler stops dispatching, so waiting requests just make the next batch fuller.
+    """
+    def __init__(self, predict_fn, executor, max_workers: int, max_batch_size: int = MICROBATCH_MAX_SIZE, max_wait_ms: float = MICROBATCH_MAX_WAIT_MS):
+        self._predict_fn = predict_fn
+        self._executor = executor
+        self._slots = threading.Semaphore(max(1, max_workers))
+        self._max_batch_size = max(1, max_batch_size)
+        self._max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._requests = 0
+        self._queue_delay_total = 0.0
+        self._queue_delay_max = 0.0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join()
+
+    def submit(self, image, served) -> Future:
+        """Queues one preprocessed image, the Future resolves to its probabilities."""
+        request = _Request(image, served)
+        self._queue.put(request)
+        return request.future
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            batches = max(self._batches, 1)
+            requests = max(self._requests, 1)
+            return {
+                "batches": self._batches,
+                "requests": self._requests,
+                "max_batch_size": self._max_batch_size,
+                "max_wait_ms": self._max_wait * 1000.0,
+                "avg_batch_size": self._requests / batches,
+                "fill_ratio": self._requests / (batches * self._max_batch_size),
+                "avg_queue_delay_ms": self._queue_delay_total / requests * 1000.0,
+                "max_queue_delay_ms": self._queue_delay_max * 1000.0,
+            }
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+
+            # wait for a free inference slot before opening the batch window.
+            self._slots.acquire()
+
+            batch = [first]
+            deadline = first.enqueued_at + self._max_wait
+            stopping = False
+            while len(batch) < self._max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+
+            self._executor.submit(self._run_batch, batch)
+            if stopping:
+                return
+
+    def _run_batch(self, batch: list):
+        try:
+            self._predict_batch(batch)
+        finally:
+            self._slots.release()
+
+    def _predict_batch(self, batch: list):
+        # callers that gave up while waiting are dropped, the others can't cancel anymore.
+        batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        started = time.monotonic()
+        delays = [started - request.enqueued_at for request in batch]
+        with self._stats_lock:
+            self._batches += 1
+            self._requests += len(batch)
+            self._queue_delay_total += sum(delays)
+            self._queue_delay_max = max(self._queue_delay_max, max(delays))
+
+        # requests queued around a version swap can point to different models.
+        groups = {}
+        for request in batch:
+            groups.setdefault(id(request.served[1]), []).append(request)
+
+        for requests in groups.values():
+            try:
+                model = requests[0].served[1]
+                output = self._predict_fn(model, np.stack([request.image for request in requests]))
+            except Exception as e:
+                logging.exception("Batched prediction failed.")
+                for request in requests:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+
+            for request, row in zip(requests, output):
+                if not request.future.done():
+                    request.future.set_result(row)
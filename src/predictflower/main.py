@@ -1,21 +1,95 @@
 import joblib
 import os
+import re
+import json
 import logging
-import tempfile
-import tensorflow as tf
-from io import BytesIO
-from keras.preprocessing import image
+import zipfile
+import asyncio
+import threading
+import time
+import numpy as np
+from typing import Optional
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from datetime import datetime
 #from sklearn.linear_model import LogisticRegression
 
-from models import Prediction
-from utils import latest_model_version, load_model # deserialize_grayscale
+from models import Prediction, Label
+from model_holder import ModelHolder, UnknownModelVersion
+from batching import BatchScheduler
+from utils import get_blob_service_client, get_queue_service_client
+from preprocessing import IMAGE_SIZE, decode_image
+from prediction_cache import create_prediction_cache, image_digest
+from staging import ImageStaging, UnknownImage
 
-def format_image(image):
-    image = tf.image.resize(image, (224, 224))/ 255.0
-    return image
+FLOWER_LIST = ["dandelion", "daisy", "tulips", "sunflowers", "roses"]
+
+# Batch endpoint settings: images per model call, decoding threads and max images per request.
+PREDICT_BATCH_SIZE = int(os.environ.get("PREDICT_BATCH_SIZE", "32"))
+DECODE_WORKERS = int(os.environ.get("DECODE_WORKERS", "4"))
+MAX_BATCH_IMAGES = int(os.environ.get("MAX_BATCH_IMAGES", "1000"))
+# Most bytes the images of a zip may inflate to.
+MAX_BATCH_BYTES = int(os.environ.get("MAX_BATCH_BYTES", str(256 * 1024 * 1024)))
+# How many model calls may run at the same time.
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "1"))
+# Largest small JPEG body /predict/tensor takes, clients resize before uploading.
+MAX_TENSOR_JPEG_BYTES = int(os.environ.get("MAX_TENSOR_JPEG_BYTES", str(512 * 1024)))
+
+# raw model input: height x width x 3 uint8, row by row.
+TENSOR_SHAPE = IMAGE_SIZE[::-1] + (3,)
+TENSOR_BYTES = int(np.prod(TENSOR_SHAPE))
+
+def predict_probabilities(model, batch):
+    """softmax probabilities for a batch of decoded uint8 images."""
+    probabilities, _ = model.predict(batch)
+    return probabilities
+
+def decode_tensor(tensor_bytes: bytes) -> np.ndarray:
+    """Raw uint8 model input from /predict/tensor, no decoding needed."""
+    return np.frombuffer(tensor_bytes, dtype=np.uint8).reshape(TENSOR_SHAPE)
+
+class UploadStats:
+    """Requests, uploaded bytes and decode time per single image endpoint."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def decode(self, endpoint: str, decode_fn, image_bytes: bytes) -> np.ndarray:
+        """Runs decode_fn(image_bytes) and counts it for the endpoint."""
+        started = time.perf_counter()
+        try:
+            return decode_fn(image_bytes)
+        finally:
+            seconds = time.perf_counter() - started
+            with self._lock:
+                endpoint_stats = self._endpoints.setdefault(endpoint, {"decoded": 0, "bytes": 0, "decode_seconds": 0.0})
+                endpoint_stats["decoded"] += 1
+                endpoint_stats["bytes"] += len(image_bytes)
+                endpoint_stats["decode_seconds"] += seconds
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                endpoint: {
+                    **endpoint_stats,
+                    "avg_bytes": endpoint_stats["bytes"] / endpoint_stats["decoded"],
+                    "avg_decode_ms": endpoint_stats["decode_seconds"] / endpoint_stats["decoded"] * 1000.0,
+                }
+                for endpoint, endpoint_stats in self._endpoints.items()
+            }
+
+def to_prediction(probabilities, version: int, label: Optional[int] = None) -> Prediction:
+    """softmax output of one image into Prediction, label is the argmax when it's already known."""
+    output_index = int(label) if label is not None else int(np.argmax(probabilities))
+    return Prediction(
+        label=output_index,
+        confidence=float(probabilities[output_index]),
+        prediction=FLOWER_LIST[output_index],
+        version=version,
+        version_iso=datetime.fromtimestamp(version).isoformat()
+    )
 
 # Set the logging level for this script
 logging.basicConfig(level=logging.INFO)
@@ -25,53 +99,253 @@ azure_logger = logging.getLogger('azure')
 azure_logger.setLevel(logging.WARNING)
 
 
+# Own executors for decoding and model calls, so they never wait behind each other
+# or behind storage I/O, which stays on the event loop.
+decode_executor = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="decode")
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+
+async def cache_call(fn, *args):
+    """
+    Runs a prediction cache call. The sqlite cache reads and writes a file, so its
+    calls go to the decode executor like hashing and decoding, the event loop never waits on disk.
+    """
+    if prediction_cache.blocking:
+        return await asyncio.get_running_loop().run_in_executor(decode_executor, fn, *args)
+    return fn(*args)
+
+def drop_old_predictions(versions: list):
+    """Keeps cached predictions of the resident versions only, in the background on the decode executor for sqlite."""
+    if prediction_cache.blocking:
+        decode_executor.submit(prediction_cache.keep_versions, versions)
+    else:
+        prediction_cache.keep_versions(versions)
+
+# models stay in memory between requests, the latest one is swapped in background when new version appears,
+# older versions asked for by requests are kept within the MODEL_POOL_BYTES budget.
+# cached predictions of versions that are not resident anymore are dropped on every new latest version,
+# prediction_cache is looked up on call because serve.py gives every worker its own.
+model_holder = ModelHolder(on_new_latest=drop_old_predictions)
+
+# concurrent single image requests are predicted together in small batches.
+batch_scheduler = BatchScheduler(predict_probabilities, inference_executor, INFERENCE_WORKERS)
+
+# repeated images are answered from cache, keyed by image hash and model version.
+prediction_cache = create_prediction_cache()
+
+upload_stats = UploadStats()
+
+# predicted images are staged by hash for a while, labeling them needs no second upload.
+image_staging = ImageStaging()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # one pooled storage client of each kind for the whole app lifetime.
+    async with get_blob_service_client() as blob_service_client, get_queue_service_client() as queue_service_client:
+        container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
+        await model_holder.start(container_client)
+        batch_scheduler.start()
+        image_staging.start(container_client, queue_service_client.get_queue_client(os.environ["STORAGE_QUEUE"]))
+        yield
+        await image_staging.stop()
+        batch_scheduler.stop()
+        await model_holder.stop()
+    inference_executor.shutdown()
+    decode_executor.shutdown()
+
 ## Lets build the predict API
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+async def acquire_model(version: Optional[int] = None) -> tuple:
+    """
+    (version, model) pair from the holder, the latest version when none is asked for.
+    503 if model is not loaded yet, 404 for a version that doesn't exist.
+    Must be given back with model_holder.release(version).
+    """
+    try:
+        return await model_holder.acquire(version)
+    except RuntimeError:
+        raise HTTPException(status_code=503, detail="Model is not loaded yet.")
+    except UnknownModelVersion:
+        raise HTTPException(status_code=404, detail=f"Model version {version} does not exist.")
+
+
+async def predict_one(image_bytes: bytes, decode_fn, endpoint: str, version: Optional[int], image_format: str = "jpeg") -> Prediction:
+    """
+    Prediction of one uploaded image, decode_fn turns its bytes into the uint8 model input.
+    An image that decoded is staged under its hash, image_format tells the modeller how to decode it.
+    """
+    # bring the resident model, same version and model for the whole request.
+    served = await acquire_model(version)
+    try:
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(decode_executor, image_digest, image_bytes)
+        probabilities = await cache_call(prediction_cache.get, digest, served[0])
+        if probabilities is None:
+            try:
+                test_image = await loop.run_in_executor(decode_executor, upload_stats.decode, endpoint, decode_fn, image_bytes)
+            except OSError:
+                raise HTTPException(status_code=400, detail="Could not decode the image.")
 
+            # waits for the micro-batch this image ends up in.
+            probabilities = await asyncio.wrap_future(batch_scheduler.submit(test_image, served))
+            await cache_call(prediction_cache.put, digest, served[0], probabilities)
+    finally:
+        model_holder.release(served[0])
+
+    # only images that decoded (now or when they were cached) are kept for labeling.
+    prediction = to_prediction(probabilities, served[0])
+    prediction.image_hash = image_staging.stage(digest, image_bytes, image_format)
+    logging.info(f"Prediction: {prediction.prediction}, confidence: {prediction.confidence}")
+    return prediction
 
 @app.post("/predict")
-def predict_hello(image_file:   UploadFile = File(...)) -> Prediction:
+async def predict_hello(image_file:   UploadFile = File(...), version: Optional[int] = None) -> Prediction:
+    """Predicts one image with the latest model, or with the model version given as ?version=."""
 
     # lets make sure that the image is correct file type.
     if image_file.content_type not in ("image/jpg", "image/jpeg"):
         raise HTTPException(status_code=400, detail="Only JPG and JPEG files are predictable.")
-    
-    # bring latest model info and bytes
-    latest_version = latest_model_version()
-    logging.info(latest_version)
-    model_bytes = load_model(latest_version) 
-    logging.info("did it work? Yes")
-    
-    #bytes into path, wont be deleting temp file.
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".keras") as temp_file:
-        temp_file.write(model_bytes) # model bytes to tempfile.
-        temp_file_path = temp_file.name
-
-    # load the model
-    model = tf.keras.models.load_model(temp_file_path)
-    logging.info(f"model: {model.summary(show_trainable=True)}")
-
-    image_bytes = image_file.file.read()
-    test_image = image.load_img(BytesIO(image_bytes))
-    test_image = format_image(test_image)
-
-    output = model.predict(tf.expand_dims(test_image, axis=0), batch_size=1)
-    #logging.info(output)
-
-    output = tf.nn.softmax(output)
-    #logging.info(f"Output: {output}")
-    output_index = tf.argmax(output, axis=1)
-    confidence = float(output[0][int(output_index)])
-    logging.info(f"Confidence: {confidence}")
-    flower_list = ["dandelion", "daisy", "tulips", "sunflowers", "roses"]
-    prediction = flower_list[int(output_index)]
-    logging.info(f"Prediction: {prediction}")
-    
-    # return prediction
-    return Prediction(
-        label=output_index,
-        confidence=confidence,
-        prediction=prediction,
-        version=latest_version,
-        version_iso=datetime.fromtimestamp(latest_version).isoformat()
-    )
+
+    return await predict_one(await image_file.read(), decode_image, "predict", version)
+
+@app.post("/predict/tensor")
+async def predict_tensor(request: Request, version: Optional[int] = None) -> Prediction:
+    """
+    Predicts one image already resized by the client, sent as the raw request body (no multipart):
+    application/octet-stream is the 224x224x3 uint8 model input as is, image/jpeg a small JPEG.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    body = await request.body()
+
+    if content_type == "application/octet-stream":
+        if len(body) != TENSOR_BYTES:
+            raise HTTPException(status_code=400, detail=f"Tensor must be {TENSOR_BYTES} bytes of {TENSOR_SHAPE} uint8.")
+        return await predict_one(body, decode_tensor, "tensor", version, image_format="rgb")
+
+    if content_type in ("image/jpg", "image/jpeg"):
+        if len(body) > MAX_TENSOR_JPEG_BYTES:
+            raise HTTPException(status_code=413, detail=f"JPEG too big, resize it to {IMAGE_SIZE[0]}x{IMAGE_SIZE[1]} first.")
+        return await predict_one(body, decode_image, "tensor_jpeg", version)
+
+    raise HTTPException(status_code=415, detail="Send application/octet-stream or image/jpeg.")
+
+@app.post("/label")
+async def label_image(label: Label) -> dict:
+    """
+    Sends an already predicted image to training with its correct label. The image is
+    referred to by the image_hash of its prediction, only a small queue message is sent.
+    404 when the image is not staged anymore, predict it again to stage it.
+    """
+    if not re.fullmatch(r"[0-9a-f]{64}", label.image_hash):
+        raise HTTPException(status_code=400, detail="image_hash must be the sha256 hex digest from a prediction.")
+    if not 0 <= label.label < len(FLOWER_LIST):
+        raise HTTPException(status_code=400, detail=f"label must be 0-{len(FLOWER_LIST) - 1}.")
+    try:
+        image_name = await image_staging.label(label.image_hash, label.label)
+    except UnknownImage:
+        raise HTTPException(status_code=404, detail="Image is not staged anymore, predict it again.")
+    return {"image_name": image_name, "label": label.label, "prediction": FLOWER_LIST[label.label]}
+
+def read_zip_images(zip_file, max_images: int = MAX_BATCH_IMAGES) -> list:
+    """
+    JPEG members of the zip in archive order, other members are skipped.
+    Member count and sizes are checked from the directory before anything is inflated,
+    zipfile never reads more than the size a member declares.
+    """
+    try:
+        with zipfile.ZipFile(zip_file) as archive:
+            members = [
+                member for member in archive.infolist()
+                if not member.is_dir() and member.filename.lower().endswith((".jpg", ".jpeg"))
+            ]
+            if len(members) > max_images:
+                raise HTTPException(status_code=413, detail=f"Too many images, at most {MAX_BATCH_IMAGES} per request.")
+            if sum(member.file_size for member in members) > MAX_BATCH_BYTES:
+                raise HTTPException(status_code=413, detail=f"Images in zip_file are larger than {MAX_BATCH_BYTES} bytes.")
+            return [archive.read(member) for member in members]
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail="zip_file is not a valid zip archive.")
+
+async def read_batch_images(image_files: list, zip_file) -> list:
+    """
+    Collects the image bytes of a batch request, from multipart files and/or from a zip.
+    """
+    images = []
+    for image_file in image_files:
+        if image_file.content_type not in ("image/jpg", "image/jpeg"):
+            raise HTTPException(status_code=400, detail=f"Only JPG and JPEG files are predictable ({image_file.filename}).")
+        images.append(await image_file.read())
+
+    if zip_file is not None:
+        images.extend(await asyncio.get_running_loop().run_in_executor(
+            decode_executor, read_zip_images, zip_file.file, MAX_BATCH_IMAGES - len(images)
+        ))
+
+    if not images:
+        raise HTTPException(status_code=400, detail="No images to predict.")
+    if len(images) > MAX_BATCH_IMAGES:
+        raise HTTPException(status_code=413, detail=f"Too many images, at most {MAX_BATCH_IMAGES} per request.")
+    return images
+
+@app.post("/predict/batch")
+async def predict_batch(image_files: list[UploadFile] = File(default=[]), zip_file: Optional[UploadFile] = File(default=None), version: Optional[int] = None) -> list[Prediction]:
+    """
+    Predicts many images in one request, given as multipart image_files and/or zip_file.
+    Images are decoded in parallel and run through the model PREDICT_BATCH_SIZE at a time.
+    All predictions are made with the same model version (the latest or ?version=),
+    results keep the input order.
+    """
+    images = await read_batch_images(image_files, zip_file)
+
+    # model is taken once, so a version swap in the middle doesn't mix versions.
+    served = await acquire_model(version)
+    try:
+        return await predict_images(images, *served)
+    finally:
+        model_holder.release(served[0])
+
+async def predict_images(images: list, version: int, model) -> list:
+    """Predictions of the image bytes with one model, cached ones are not run again."""
+    loop = asyncio.get_running_loop()
+    predictions = []
+    for start in range(0, len(images), PREDICT_BATCH_SIZE):
+        chunk = images[start:start + PREDICT_BATCH_SIZE]
+        digests = await asyncio.gather(*(loop.run_in_executor(decode_executor, image_digest, image_bytes) for image_bytes in chunk))
+        outputs = await cache_call(lambda: [prediction_cache.get(digest, version) for digest in digests])
+        labels = [None] * len(chunk)
+
+        # only the images missing from cache are decoded and predicted.
+        missing = [index for index, output in enumerate(outputs) if output is None]
+        if missing:
+            try:
+                decoded = await asyncio.gather(*(loop.run_in_executor(decode_executor, decode_image, chunk[index]) for index in missing))
+            except OSError:
+                raise HTTPException(status_code=400, detail="Could not decode all the images.")
+
+            output, output_labels = await loop.run_in_executor(inference_executor, model.predict, np.stack(decoded))
+            for index, row, label in zip(missing, output, output_labels):
+                outputs[index] = row
+                labels[index] = label
+            await cache_call(lambda: [prediction_cache.put(digests[index], version, outputs[index]) for index in missing])
+
+        predictions.extend(to_prediction(row, version, label) for row, label in zip(outputs, labels))
+
+    logging.info(f"Predicted a batch of {len(predictions)} images with model version {version}.")
+    return predictions
+
+@app.get("/metrics")
+async def metrics() -> dict:
+    """Serving statistics, micro-batch fill ratio, queueing delay, prediction cache, model pool, upload and staging counters."""
+    stats = {
+        "batching": batch_scheduler.stats(),
+        "model_pool": model_holder.stats(),
+        "prediction_cache": await cache_call(prediction_cache.stats),
+        "uploads": upload_stats.stats(),
+        "staging": image_staging.stats(),
+    }
+    # memory and requests/s of every worker, written by serve.py when it runs the workers.
+    stats_file = os.environ.get("SERVE_STATS_FILE")
+    if stats_file and os.path.exists(stats_file):
+        with open(stats_file) as workers_file:
+            stats["workers"] = json.load(workers_file)
+    return stats
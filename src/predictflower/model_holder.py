@@ -0,0 +1,251 @@
+import os
+import asyncio
+import logging
+import time
+
+from typing import Optional
+
+from collections import OrderedDict
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from utils import latest_manifest, load_artifact, load_version_record
+from backends import PREDICT_BACKEND, build_backend
+from deltas import deserialize_delta
+
+# How often (seconds) the background task looks for a newer model version, 0 turns it off.
+MODEL_POLL_SECONDS = float(os.environ.get("MODEL_POLL_SECONDS", "30"))
+
+# RAM (bytes) all loaded model versions may take together, least recently used ones go first.
+# The latest version and versions with predictions running are never unloaded.
+MODEL_POOL_BYTES = int(os.environ.get("MODEL_POOL_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+def build_model(backend_name: str, model_bytes=None, base=None, delta_files: list = ()):
+    """
+    Builds the serving backend from the model bytes, or from an already loaded base
+    backend, applies the (bytes, sha256) weight deltas on a copy and warms up
+    every serving batch size, so the first real request is not slowed down.
+    """
+    model = base if base is not None else build_backend(backend_name, model_bytes)
+    if delta_files:
+        model = model.with_deltas([deserialize_delta(delta_bytes, checksum) for delta_bytes, checksum in delta_files])
+    model.warmup()
+    return model
+
+class UnknownModelVersion(Exception):
+    pass
+
+def select_artifact(manifest: dict) -> tuple:
+    """(backend name, blob name) to load for the manifest's version."""
+    if PREDICT_BACKEND == "tflite":
+        if "tflite" in manifest:
+            return "tflite", manifest["tflite"]["blob"]
+        logging.warning(f"Model version {manifest['version']} has no TFLite artifact, serving it with keras.")
+    return "keras", manifest.get("blob", f"models/flowersmodel_{manifest['version']}.keras")
+
+class _PooledModel:
+    def __init__(self, version: int, model):
+        self.version = version
+        self.model = model
+        self.size = model.memory_bytes()
+        self.refs = 0 # requests using the model right now
+
+class ModelHolder:
+    """
+    Keeps the served model versions resident in memory.
+
+    The latest version is loaded and warmed once, a background task polls for
+    newer versions and switches the latest one with one assignment, so requests
+    always see a complete model and never wait on loading. Older or pinned
+    versions asked for by requests are loaded on demand and kept while they fit
+    in MODEL_POOL_BYTES, least recently used ones are unloaded first.
+
+    Requests acquire() a version and release() it when done. A version in use is
+    not unloaded until its last request releases it, the latest one never is.
+    Deserialization runs in the default executor, off the event loop and
+    outside the inference executor.
+
+    on_new_latest(versions) is called with the resident versions every time
+    a new latest version is served.
+    """
+    def __init__(self, poll_seconds: float = MODEL_POLL_SECONDS, max_bytes: int = MODEL_POOL_BYTES, on_new_latest=None):
+        self._models = OrderedDict() # version -> _PooledModel, least recently used first
+        self._loading = {} # version -> task loading it, so concurrent requests share one load
+        self._latest = None
+        self._poll_seconds = poll_seconds
+        self._max_bytes = max_bytes
+        self._on_new_latest = on_new_latest
+        self._container_client = None
+        self._task = None
+
+        self._hits = 0
+        self._loads = 0
+        self._evictions = 0
+
+    async def start(self, container_client):
+        """Loads the latest model and starts the background watcher."""
+        self._container_client = container_client
+        await self.refresh()
+        if self._poll_seconds > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def preload(self, container_client):
+        """
+        Loads the latest model without starting the watcher, the pre-fork launcher
+        (serve.py) does this in the parent so forked workers share the weights.
+        """
+        self._container_client = container_client
+        await self.refresh()
+        self._container_client = None
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def get(self) -> tuple:
+        """Returns the (version, model) pair of the latest version."""
+        if self._latest is None:
+            raise RuntimeError("No model loaded yet.")
+        entry = self._models[self._latest]
+        return entry.version, entry.model
+
+    async def acquire(self, version: Optional[int] = None) -> tuple:
+        """
+        (version, model) pair of the given version, the latest one when None.
+        Loads the version if it's not in memory. Raises RuntimeError before the
+        first model is loaded and UnknownModelVersion for versions that don't exist.
+        Every acquire() must be followed by release(version).
+        """
+        if version is None:
+            if self._latest is None:
+                raise RuntimeError("No model loaded yet.")
+            version = self._latest
+
+        entry = self._models.get(version)
+        if entry is not None:
+            self._hits += 1
+        else:
+            entry = await self._load_shared(version)
+        self._models.move_to_end(version)
+        entry.refs += 1
+        self._evict()
+        return entry.version, entry.model
+
+    def release(self, version: int):
+        self._models[version].refs -= 1
+        self._evict()
+
+    async def _load_shared(self, version: int, record: Optional[dict] = None) -> _PooledModel:
+        """Loads the version into the pool, or waits for the load another request started."""
+        task = self._loading.get(version)
+        if task is None:
+            task = asyncio.create_task(self._load(version, record))
+            self._loading[version] = task
+            task.add_done_callback(lambda _: self._loading.pop(version, None))
+        # a request giving up doesn't cancel the load for the others.
+        entry = await asyncio.shield(task)
+        # the loaded model goes (back) to the pool, it may have been unloaded while this request waited.
+        return self._models.setdefault(version, entry)
+
+    async def _load(self, version: int, record: Optional[dict] = None) -> _PooledModel:
+        started = time.perf_counter()
+        try:
+            if record is None:
+                record = await load_version_record(self._container_client, version)
+            backend_name, blob_name = select_artifact(record)
+            if backend_name == "keras" and record.get("artifact") == "delta":
+                model = await self._build_from_deltas(record)
+            else:
+                model_bytes = await load_artifact(self._container_client, blob_name)
+                model = await asyncio.get_running_loop().run_in_executor(None, build_model, backend_name, model_bytes)
+                # raw bytes are not needed once the model exists.
+                del model_bytes
+        except ResourceNotFoundError:
+            raise UnknownModelVersion(f"Model version {version} does not exist.")
+        except HttpResponseError as error:
+            # retention in archive mode moves old versions (record and files) to the Archive tier.
+            if error.error_code == "BlobArchived":
+                raise UnknownModelVersion(f"Model version {version} is archived.")
+            raise
+
+        entry = _PooledModel(version, model)
+        self._loads += 1
+        logging.info(
+            f"Loaded model version {version} with {backend_name} in {time.perf_counter() - started:.2f} s, "
+            f"{entry.size} bytes."
+        )
+        return entry
+
+    def _evict(self):
+        """Unloads least recently used versions until the pool fits in its budget."""
+        total = sum(entry.size for entry in self._models.values())
+        for version, entry in list(self._models.items()):
+            if total <= self._max_bytes:
+                break
+            if version == self._latest or entry.refs > 0:
+                continue
+            del self._models[version]
+            total -= entry.size
+            self._evictions += 1
+            logging.info(f"Unloaded model version {version}, {entry.size} bytes.")
+
+    def stats(self) -> dict:
+        return {
+            "versions": list(self._models),
+            "latest": self._latest,
+            "bytes": sum(entry.size for entry in self._models.values()),
+            "max_bytes": self._max_bytes,
+            "hits": self._hits,
+            "loads": self._loads,
+            "evictions": self._evictions,
+        }
+
+    async def refresh(self):
+        """Makes the manifest's version the latest one, loading it if needed."""
+        manifest = await latest_manifest(self._container_client)
+        version = manifest["version"]
+        if version == self._latest:
+            return
+
+        if version not in self._models:
+            await self._load_shared(version, manifest)
+        self._latest = version
+        self._evict()
+        logging.info(f"Serving model version {version} as the latest.")
+        if self._on_new_latest is not None:
+            self._on_new_latest(list(self._models))
+
+    async def _build_from_deltas(self, record: dict):
+        """
+        Builds a delta version. Usually its parent is already loaded and only the
+        delta (kilobytes) is downloaded and applied on a copy of it. Otherwise the
+        chain is followed back to a loaded version or to its full .keras file.
+        """
+        base = None
+        chain = []
+        while record.get("artifact", "full") == "delta":
+            chain.append(record)
+            parent = self._models.get(record["parent"])
+            if parent is not None and parent.model.name == "keras":
+                base = parent.model
+                break
+            record = await load_version_record(self._container_client, record["parent"])
+
+        delta_files = [
+            (await load_artifact(self._container_client, delta_record["blob"]), delta_record["sha256"])
+            for delta_record in reversed(chain)
+        ]
+        base_bytes = None if base is not None else await load_artifact(self._container_client, record["blob"])
+        logging.info(f"Applying {len(delta_files)} deltas on {'a loaded model' if base is not None else record['blob']}.")
+        return await asyncio.get_running_loop().run_in_executor(None, build_model, "keras", base_bytes, base, delta_files)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._poll_seconds)
+            try:
+                await self.refresh()
+            except Exception:
+                # keep serving the old model, try again on next poll.
+                logging.exception("Model refresh failed.")
@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic import BaseModel
 
 class Prediction(BaseModel):
@@ -6,3 +7,9 @@ class Prediction(BaseModel):
     prediction: str
     version: int
     version_iso: str
+    # content hash of the staged image, POST it to /label instead of the image.
+    image_hash: Optional[str] = None
+
+class Label(BaseModel):
+    image_hash: str
+    label: int
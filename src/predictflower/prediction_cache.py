@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Optional
+
+# "memory" (LRU inside the process), "sqlite" (file shared by the processes on the node) or "off".
+PREDICTION_CACHE = os.environ.get("PREDICTION_CACHE", "memory").lower()
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", "10000"))
+PREDICTION_CACHE_TTL_SECONDS = float(os.environ.get("PREDICTION_CACHE_TTL_SECONDS", "3600"))
+PREDICTION_CACHE_PATH = os.environ.get("PREDICTION_CACHE_PATH", "./prediction_cache.sqlite")
+
+def image_digest(image_bytes: bytes) -> str:
+    """Content hash of the uploaded image, same bytes give the same key."""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+class MemoryBackend:
+    """LRU with TTL in a dict, only seen by this process."""
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self._entries = OrderedDict() # key -> (expires_at, version, value)
+        self._max_entries = max_entries
+        self._ttl = ttl_seconds
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[list]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def put(self, key: str, version: int, value: list):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self._ttl, version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def keep_versions(self, versions: list):
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[1] not in versions]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+class SqliteBackend:
+    """
+    LRU with TTL in a local sqlite file, so every worker process on the node
+    shares the same cached predictions.
+    """
+    def __init__(self, path: str, max_entries: int, ttl_seconds: float):
+        self._max_entries = max_entries
+        self._ttl = ttl_seconds
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS predictions "
+            "(key TEXT PRIMARY KEY, version INTEGER, value TEXT, expires_at REAL, used_at REAL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS predictions_used_at ON predictions (used_at)")
+
+    def get(self, key: str) -> Optional[list]:
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT value, expires_at FROM predictions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._connection.execute("DELETE FROM predictions WHERE key = ?", (key,))
+                return None
+            self._connection.execute("UPDATE predictions SET used_at = ? WHERE key = ?", (now, key))
+            return json.loads(row[0])
+
+    def put(self, key: str, version: int, value: list):
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)",
+                (key, version, json.dumps(value), now + self._ttl, now)
+            )
+            self._connection.execute(
+                "DELETE FROM predictions WHERE key IN "
+                "(SELECT key FROM predictions ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self._max_entries,)
+            )
+
+    def keep_versions(self, versions: list):
+        versions = list(versions)
+        with self._lock:
+            self._connection.execute(
+                f"DELETE FROM predictions WHERE version NOT IN ({', '.join('?' * len(versions))})",
+                versions
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+class PredictionCache:
+    """
+    Softmax outputs keyed by image content hash and model version.
+
+    The version is part of the key, so a new model never answers with old
+    results and requests pinned to different versions all get their hits.
+    When a new latest version is served, entries of versions no longer
+    resident are dropped with keep_versions(), so they don't take space
+    until they expire.
+    """
+    def __init__(self, backend):
+        self._backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._backend is not None
+
+    @property
+    def blocking(self) -> bool:
+        """True when calls do file I/O (sqlite), async code should run them on an executor."""
+        return isinstance(self._backend, SqliteBackend)
+
+    def get(self, digest: str, version: int) -> Optional[list]:
+        if not self.enabled:
+            return None
+        value = self._backend.get(f"{version}:{digest}")
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, digest: str, version: int, probabilities) -> None:
+        if not self.enabled:
+            return
+        self._backend.put(f"{version}:{digest}", version, [float(p) for p in probabilities])
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": PREDICTION_CACHE,
+            "entries": len(self._backend) if self.enabled else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    def keep_versions(self, versions: list) -> None:
+        """Drops cached predictions of every version not in versions."""
+        if self.enabled and versions:
+            self._backend.keep_versions(versions)
+
+def create_prediction_cache() -> PredictionCache:
+    if PREDICTION_CACHE == "memory":
+        return PredictionCache(MemoryBackend(PREDICTION_CACHE_SIZE, PREDICTION_CACHE_TTL_SECONDS))
+    if PREDICTION_CACHE == "sqlite":
+        return PredictionCache(SqliteBackend(PREDICTION_CACHE_PATH, PREDICTION_CACHE_SIZE, PREDICTION_CACHE_TTL_SECONDS))
+    return PredictionCache(None)
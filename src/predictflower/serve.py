@@ -0,0 +1,336 @@
+import os
+import json
+import time
+import signal
+import socket
+import asyncio
+import logging
+import multiprocessing
+
+# Pre-fork serving: one parent process loads the model and forks SERVE_WORKERS
+# uvicorn workers that accept on the same socket, so the GIL is not shared and
+# the loaded TFLite model is shared copy-on-write between the workers.
+SERVE_WORKERS = int(os.environ.get("SERVE_WORKERS", "1"))
+SERVE_HOST = os.environ.get("SERVE_HOST", "0.0.0.0")
+SERVE_PORT = int(os.environ.get("SERVE_PORT", "8888"))
+# How often (seconds) the parent looks for a newer model version and reports worker memory and requests/s.
+SERVE_POLL_SECONDS = float(os.environ.get("MODEL_POLL_SECONDS", "30"))
+SERVE_STATS_SECONDS = float(os.environ.get("SERVE_STATS_SECONDS", "60"))
+# Seconds a new generation of workers may take to load, otherwise it's stopped and the old one keeps serving.
+SERVE_READY_TIMEOUT_SECONDS = float(os.environ.get("SERVE_READY_TIMEOUT_SECONDS", "300"))
+# Most seconds between tries of a version whose workers did not start.
+SERVE_ROLLOUT_RETRY_MAX_SECONDS = float(os.environ.get("SERVE_ROLLOUT_RETRY_MAX_SECONDS", "3600"))
+# Most seconds a worker that keeps crashing before it has started waits to be started again.
+SERVE_RESTART_MAX_SECONDS = float(os.environ.get("SERVE_RESTART_MAX_SECONDS", "60"))
+# Worker stats are written here, /metrics of every worker shows them.
+SERVE_STATS_FILE = os.environ.setdefault("SERVE_STATS_FILE", "/tmp/predictflower_workers.json")
+
+# workers don't look for new versions themselves, the parent starts a new generation of them.
+os.environ["MODEL_POLL_SECONDS"] = "0"
+
+import uvicorn
+import main
+
+from backends import PREDICT_BACKEND, TFLITE_THREADS
+from prediction_cache import create_prediction_cache
+from utils import get_blob_service_client, latest_manifest
+
+# TFLite with one thread never starts the TF runtime or any threads, so it can be
+# loaded before forking. TF itself is not fork safe, keras workers load the model
+# themselves after the fork.
+PRELOAD = PREDICT_BACKEND == "tflite" and TFLITE_THREADS == 1
+
+# two generations of workers run side by side while a new version is rolled out.
+SLOTS = 2 * max(1, SERVE_WORKERS)
+
+def worker_memory(pid: int) -> dict:
+    """Rss, Pss and shared/private bytes of a process, from /proc/<pid>/smaps_rollup."""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as smaps:
+        for line in smaps:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    return {
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+        "private": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+    }
+
+def cpu_seconds(pid: int) -> float:
+    """User + system CPU time of a process."""
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+class WorkerServer(uvicorn.Server):
+    """uvicorn server that marks its slot ready once the app has loaded its model."""
+    def __init__(self, config, slot: int, shared):
+        super().__init__(config)
+        self._slot = slot
+        self._shared = shared
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets=sockets)
+        if not self.should_exit:
+            self._shared[2 * self._slot] = 1
+
+def run_worker(sock: socket.socket, slot: int, shared):
+    """Forked worker: serves main.app on the shared socket until SIGTERM."""
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_DFL)
+    # the sqlite prediction cache connection can't be shared with the parent.
+    main.prediction_cache = create_prediction_cache()
+
+    async def app(scope, receive, send):
+        if scope["type"] == "http":
+            shared[2 * slot + 1] += 1
+        await main.app(scope, receive, send)
+
+    config = uvicorn.Config(app, lifespan="on")
+    WorkerServer(config, slot, shared).run(sockets=[sock])
+
+async def load_latest() -> int:
+    """Latest version in the manifest, loaded into the parent's model holder when it can be."""
+    async with get_blob_service_client() as blob_service_client:
+        container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
+        manifest = await latest_manifest(container_client)
+        if PRELOAD and "tflite" in manifest:
+            await main.model_holder.preload(container_client)
+        return manifest["version"]
+
+class Supervisor:
+    """
+    Parent process of the workers.
+
+    Workers of one generation serve one model version. When a new version appears
+    the parent loads it, forks a new generation, waits until its workers have
+    started and sends SIGTERM to the old ones, which finish their requests and exit.
+    If the new generation doesn't start in time it is killed, the old one keeps
+    serving and the version is tried again later, waiting twice as long each time.
+    SIGHUP starts a new generation right away. Workers count their requests in
+    shared memory, the parent reads them with the memory of every worker from /proc.
+    A worker that crashes before it has started is started again after 1, 3, 7...
+    seconds (at most SERVE_RESTART_MAX_SECONDS), so a broken model or config
+    doesn't fork workers in a loop.
+    """
+    def __init__(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((SERVE_HOST, SERVE_PORT))
+        self._sock.listen(2048)
+
+        # per slot: started flag and request count.
+        self._shared = multiprocessing.RawArray("q", 2 * SLOTS)
+        self._workers = {} # pid -> slot, current generation
+        self._old_workers = {} # pid -> slot, finishing their requests
+        self._previous = {} # pid -> slot, serving until the new generation has started
+        self._failures = {} # slot -> crashes in a row before the worker started
+        self._restarts = {} # slot -> time.monotonic() when its crashed worker is started again
+        self._version = None
+        self._failed_version = None # version whose workers did not start
+        self._rollout_failures = 0
+        self._rollout_retry_at = 0.0
+        self._stopping = False
+        self._reload = False
+        self._last_stats = (time.monotonic(), {})
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._request_reload)
+
+        self._version = asyncio.run(load_latest())
+        self._spawn_generation()
+        logging.info(f"Serving model version {self._version} with {SERVE_WORKERS} workers on port {SERVE_PORT}.")
+
+        next_poll = time.monotonic() + SERVE_POLL_SECONDS
+        next_stats = time.monotonic() + SERVE_STATS_SECONDS
+        while not self._stopping:
+            time.sleep(1)
+            self._reap()
+            self._restart_due()
+            if self._reload or (SERVE_POLL_SECONDS > 0 and time.monotonic() >= next_poll):
+                next_poll = time.monotonic() + SERVE_POLL_SECONDS
+                self._check_version()
+            if SERVE_STATS_SECONDS > 0 and time.monotonic() >= next_stats:
+                next_stats = time.monotonic() + SERVE_STATS_SECONDS
+                self._report()
+
+        for pid in list(self._workers) + list(self._old_workers):
+            os.kill(pid, signal.SIGTERM)
+        for pid in list(self._workers) + list(self._old_workers):
+            os.waitpid(pid, 0)
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _request_reload(self, signum, frame):
+        self._reload = True
+
+    def _spawn(self, slot: int) -> int:
+        self._shared[2 * slot] = 0
+        self._shared[2 * slot + 1] = 0
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(self._sock, slot, self._shared)
+            finally:
+                os._exit(0)
+        self._workers[pid] = slot
+        return pid
+
+    def _spawn_generation(self):
+        used = set(self._workers.values()) | set(self._old_workers.values())
+        free = [slot for slot in range(SLOTS) if slot not in used]
+        for slot in free[:SERVE_WORKERS]:
+            self._spawn(slot)
+
+    def _reap(self):
+        """Collects exited workers, a crashed worker of the current generation is scheduled to start again."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self._old_workers.pop(pid, None)
+            self._previous.pop(pid, None)
+            slot = self._workers.pop(pid, None)
+            if slot is not None and not self._stopping:
+                if self._shared[2 * slot]:
+                    # it was serving, not broken from the start.
+                    self._failures[slot] = 0
+                failures = self._failures.get(slot, 0)
+                self._failures[slot] = failures + 1
+                delay = min(SERVE_RESTART_MAX_SECONDS, 2 ** failures - 1)
+                logging.warning(f"Worker {pid} exited with status {status}, starting it again in {delay:.0f} s.")
+                self._restarts[slot] = time.monotonic() + delay
+
+    def _restart_due(self):
+        now = time.monotonic()
+        for slot, restart_at in list(self._restarts.items()):
+            if now >= restart_at:
+                del self._restarts[slot]
+                self._spawn(slot)
+
+    def _check_version(self):
+        reload, self._reload = self._reload, False
+        try:
+            version = asyncio.run(load_latest())
+        except Exception:
+            # keep serving the old version, try again on next poll.
+            logging.exception("Model refresh failed.")
+            return
+        if version == self._version and not reload:
+            return
+        if version == self._failed_version and not reload and time.monotonic() < self._rollout_retry_at:
+            return
+        if len(self._workers) + len(self._old_workers) + SERVE_WORKERS > SLOTS:
+            logging.info("Old workers are still finishing, new version waits for the next poll.")
+            self._reload = reload
+            return
+
+        # crashed workers of the old generation are replaced by the new one.
+        old_workers, old_restarts, old_failures = self._workers, self._restarts, self._failures
+        self._previous = old_workers
+        self._workers = {}
+        self._restarts = {}
+        self._failures = {}
+        self._spawn_generation()
+        ready = self._wait_ready()
+        self._previous = {}
+        if not ready:
+            self._roll_back(version, old_workers, old_restarts, old_failures)
+            return
+
+        for pid in old_workers:
+            os.kill(pid, signal.SIGTERM)
+        self._old_workers.update(old_workers)
+        logging.info(f"Model version {version} is served by a new generation of {len(self._workers)} workers.")
+        self._version = version
+        self._failed_version = None
+        self._rollout_failures = 0
+
+    def _roll_back(self, version: int, old_workers: dict, old_restarts: dict, old_failures: dict):
+        """Kills the new generation that did not start, the old one keeps serving."""
+        for pid in self._workers:
+            os.kill(pid, signal.SIGKILL)
+        self._old_workers.update(self._workers)
+
+        # old workers that exited meanwhile (_reap took them out) are started again.
+        self._workers, self._restarts, self._failures = old_workers, old_restarts, old_failures
+        used = set(old_workers.values()) | set(old_restarts) | set(self._old_workers.values())
+        free = [slot for slot in range(SLOTS) if slot not in used]
+        for slot in free[:SERVE_WORKERS - len(old_workers) - len(old_restarts)]:
+            self._restarts[slot] = time.monotonic()
+
+        if version != self._failed_version:
+            self._failed_version = version
+            self._rollout_failures = 0
+        delay = min(SERVE_ROLLOUT_RETRY_MAX_SECONDS, max(SERVE_POLL_SECONDS, 1) * 2 ** self._rollout_failures)
+        self._rollout_failures += 1
+        self._rollout_retry_at = time.monotonic() + delay
+        logging.error(
+            f"Workers of model version {version} did not start in time, "
+            f"version {self._version} keeps serving, trying again in {delay:.0f} s."
+        )
+
+    def _wait_ready(self) -> bool:
+        """Waits until every new worker has started, so the old ones can stop without a gap. False if they didn't."""
+        deadline = time.monotonic() + SERVE_READY_TIMEOUT_SECONDS
+        while time.monotonic() < deadline and not self._stopping:
+            if not self._restarts and all(self._shared[2 * slot] for slot in self._workers.values()):
+                return True
+            time.sleep(0.2)
+            self._reap()
+            self._restart_due()
+        return False
+
+    def _report(self):
+        """Memory per worker and requests/s per worker and per used core, logged and written to SERVE_STATS_FILE."""
+        now = time.monotonic()
+        last_time, last = self._last_stats
+        interval = max(now - last_time, 1e-9)
+        workers = {}
+        current = {}
+        for pid, slot in self._workers.items():
+            try:
+                memory = worker_memory(pid)
+                cpu = cpu_seconds(pid)
+            except FileNotFoundError:
+                continue
+            requests = self._shared[2 * slot + 1]
+            current[pid] = (requests, cpu)
+            last_requests, last_cpu = last.get(pid, (0, 0.0))
+            workers[pid] = {
+                **memory,
+                "requests_per_second": (requests - last_requests) / interval,
+                "cpu_cores": (cpu - last_cpu) / interval,
+            }
+        self._last_stats = (now, current)
+
+        requests_per_second = sum(worker["requests_per_second"] for worker in workers.values())
+        cores = sum(worker["cpu_cores"] for worker in workers.values())
+        stats = {
+            "version": self._version,
+            "workers": workers,
+            "requests_per_second": requests_per_second,
+            "requests_per_core_second": requests_per_second / cores if cores > 0 else 0.0,
+            "pss_total": sum(worker["pss"] for worker in workers.values()),
+        }
+        temp_path = SERVE_STATS_FILE + ".tmp"
+        with open(temp_path, "w") as stats_file:
+            json.dump(stats, stats_file)
+        os.replace(temp_path, SERVE_STATS_FILE)
+
+        logging.info(
+            f"{len(workers)} workers: {requests_per_second:.1f} requests/s, "
+            f"{stats['requests_per_core_second']:.1f} requests/s per core, "
+            f"{stats['pss_total'] / 2 ** 20:.0f} MiB PSS in total."
+        )
+
+if __name__ == "__main__":
+    Supervisor().run()
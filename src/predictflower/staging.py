@@ -0,0 +1,176 @@
+import os
+import json
+import uuid
+import time
+import asyncio
+import logging
+
+from typing import Optional
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+# Predicted images are kept this long (seconds) under staging/, so a label can refer to them
+# by hash instead of uploading the image again. 0 turns staging off.
+STAGING_TTL_SECONDS = float(os.environ.get("STAGING_TTL_SECONDS", "3600"))
+# How often (seconds) staged images nobody labeled are deleted.
+STAGING_SWEEP_SECONDS = float(os.environ.get("STAGING_SWEEP_SECONDS", "600"))
+
+STAGING_PREFIX = "staging/"
+LABELED_PREFIX = "labeled/"
+
+def staged_blob(image_hash: str) -> str:
+    return f"{STAGING_PREFIX}{image_hash}"
+
+def labeled_blob(image_hash: str) -> str:
+    """Own name for every label, like the uuid names flowerui uploads, so relabeling makes a new sample."""
+    return f"{LABELED_PREFIX}{uuid.uuid4()}_{image_hash}"
+
+class UnknownImage(Exception):
+    pass
+
+class ImageStaging:
+    """
+    Short lived copies of predicted images, named by their content hash.
+
+    stage() uploads the image in the background, the prediction doesn't wait for it.
+    An image this process staged recently is not uploaded again. label() has storage
+    copy the staged image to a name of its own under labeled/ and puts {image_name,
+    label} to the training queue, the modeller deletes the copy once it's in its buffer.
+    Every label is its own sample, also when the same image is labeled again.
+    A background task deletes staged images older than the TTL.
+    Blob metadata tells the image format ("jpeg" or "rgb", raw model input).
+    """
+    def __init__(self, ttl_seconds: float = STAGING_TTL_SECONDS, sweep_seconds: float = STAGING_SWEEP_SECONDS):
+        self._ttl = ttl_seconds
+        self._sweep_seconds = sweep_seconds
+        self._staged = {} # hash -> time.monotonic() of our upload
+        self._uploads = {} # hash -> upload task still running
+        self._container_client = None
+        self._queue_client = None
+        self._task = None
+
+        self._uploaded = 0
+        self._reused = 0
+        self._labeled = 0
+        self._expired = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._ttl > 0
+
+    def start(self, container_client, queue_client):
+        self._container_client = container_client
+        self._queue_client = queue_client
+        if self.enabled and self._sweep_seconds > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._uploads:
+            await asyncio.gather(*self._uploads.values(), return_exceptions=True)
+
+    def stage(self, image_hash: str, image_bytes: bytes, image_format: str) -> Optional[str]:
+        """Starts staging the image, returns its hash, None when staging is off."""
+        if not self.enabled or self._container_client is None:
+            return None
+        staged_at = self._staged.get(image_hash)
+        if image_hash in self._uploads or (staged_at is not None and time.monotonic() - staged_at < self._ttl / 2):
+            self._reused += 1
+            return image_hash
+
+        task = asyncio.create_task(self._upload(image_hash, image_bytes, image_format))
+        self._uploads[image_hash] = task
+        task.add_done_callback(lambda _: self._uploads.pop(image_hash, None))
+        return image_hash
+
+    async def _upload(self, image_hash: str, image_bytes: bytes, image_format: str):
+        try:
+            blob_client = self._container_client.get_blob_client(staged_blob(image_hash))
+            try:
+                await blob_client.upload_blob(image_bytes, overwrite=False, metadata={"format": image_format})
+                self._uploaded += 1
+            except ResourceExistsError:
+                # already staged, only its age is reset.
+                properties = await blob_client.get_blob_properties()
+                await blob_client.set_blob_metadata(properties.metadata)
+                self._reused += 1
+        except Exception:
+            logging.exception(f"Staging image {image_hash} failed.")
+            return
+        self._staged[image_hash] = time.monotonic()
+
+    async def label(self, image_hash: str, label: int) -> str:
+        """
+        Queues the staged image for training with the label, returns its blob name.
+        Raises UnknownImage when the image is not staged (anymore).
+        """
+        if not self.enabled:
+            raise UnknownImage(image_hash)
+        upload = self._uploads.get(image_hash)
+        if upload is not None:
+            await asyncio.shield(upload)
+
+        # copied by storage inside the account, the image bytes never pass through this service.
+        # the copy gets the metadata (format) of the staged image.
+        image_name = labeled_blob(image_hash)
+        blob_client = self._container_client.get_blob_client(image_name)
+        try:
+            copy = await blob_client.start_copy_from_url(self._container_client.get_blob_client(staged_blob(image_hash)).url)
+        except ResourceNotFoundError:
+            self._staged.pop(image_hash, None)
+            raise UnknownImage(image_hash)
+        # copies in the same account are usually done right away, the modeller must not find a half copy.
+        status = copy["copy_status"]
+        while status == "pending":
+            await asyncio.sleep(0.1)
+            status = (await blob_client.get_blob_properties()).copy.status
+        if status != "success":
+            raise RuntimeError(f"Copying the staged image {image_hash} ended as {status}.")
+
+        await self._queue_client.send_message(json.dumps({"image_name": image_name, "label": label}))
+        self._labeled += 1
+        logging.info(f"Message ({image_name}) as ({label}) sent to the training queue.")
+        return image_name
+
+    async def sweep(self) -> int:
+        """Deletes staged images older than the TTL, returns how many. Labels have their own copies."""
+        cutoff = time.time() - self._ttl
+        expired = [
+            {"name": blob.name, "etag": blob.etag, "match_condition": MatchConditions.IfNotModified}
+            async for blob in self._container_client.list_blobs(name_starts_with=STAGING_PREFIX)
+            if blob.last_modified.timestamp() < cutoff
+        ]
+        # one batch request can hold at most 256 deletes.
+        for start in range(0, len(expired), 256):
+            await self._container_client.delete_blobs(*expired[start:start + 256], raise_on_any_failure=False)
+
+        now = time.monotonic()
+        self._staged = {image_hash: staged_at for image_hash, staged_at in self._staged.items() if now - staged_at < self._ttl}
+        self._expired += len(expired)
+        if expired:
+            logging.info(f"Deleted {len(expired)} expired staged images.")
+        return len(expired)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "ttl_seconds": self._ttl,
+            "uploaded": self._uploaded,
+            "reused": self._reused,
+            "labeled": self._labeled,
+            "expired": self._expired,
+        }
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._sweep_seconds)
+            try:
+                await self.sweep()
+            except Exception:
+                # try again on next round.
+                logging.exception("Cleaning up staged images failed.")
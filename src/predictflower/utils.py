@@ -1,21 +1,36 @@
 import zlib
 import numpy as np
 import os
+import json
 import logging
+import asyncio
+import time
 import joblib
 
 from io import BytesIO
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob.aio import BlobServiceClient
+from azure.storage.queue.aio import QueueServiceClient
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from base64 import b64decode, b64encode
 from PIL import Image
-from datetime import datetime
-from functools import lru_cache
+from artifact_cache import artifact_cache
 from io import BytesIO
 #from keras.preprocessing import image
 
 # Are we running in the cloud?
 CLOUD = os.environ.get("USE_AZURE_CREDENTIAL", "false").lower() == "true"
 
+# Small json blob published by the modeller, tells which model version is the newest one.
+MANIFEST_BLOB = "models/manifest.json"
+
+# How long (seconds) the read manifest is trusted before asking storage again.
+MANIFEST_TTL_SECONDS = float(os.environ.get("MANIFEST_TTL_SECONDS", "10"))
+
+# Models are downloaded in ranges of this size, this many ranges at a time.
+MODEL_CHUNK_BYTES = int(os.environ.get("MODEL_CHUNK_BYTES", str(4 * 1024 * 1024)))
+MODEL_DOWNLOAD_CONCURRENCY = int(os.environ.get("MODEL_DOWNLOAD_CONCURRENCY", "8"))
+
 def deserialize_grayscale(compressed_b64:str, size=(20, 40), has_label=False) -> tuple[Image.Image, int]:
     """Decompress the base64 string and convert it to an image.
     """
@@ -39,55 +54,136 @@ def deserialize_grayscale(compressed_b64:str, size=(20, 40), has_label=False) ->
 
 def get_blob_service_client():
     """
-    Function brings the blob service client from azurite or azure.
+    Function brings the async blob service client from azurite or azure.
+    Only one client is opened for the whole app lifetime, see lifespan in main.py.
 
     The STORAGE_CONNECTION_STRING is only set up when running in the cloud. 
     If it's not set, we're running locally with Azurite.
     """
     if CLOUD:
-        from azure.identity import DefaultAzureCredential # type: ignore
+        from azure.identity.aio import DefaultAzureCredential # type: ignore
         credential = DefaultAzureCredential()
         account_url = os.environ["STORAGE_BLOB_URL"]
         return BlobServiceClient(account_url=account_url, credential=credential)
     else:
         return BlobServiceClient.from_connection_string(os.environ["STORAGE_CONNECTION_STRING"])
 
-def latest_model_version() -> int:
+def get_queue_service_client():
+    """
+    Async queue service client from azurite or azure, opened once like the blob client.
+    Used to put labeled images to the training queue.
+    """
+    if CLOUD:
+        from azure.identity.aio import DefaultAzureCredential # type: ignore
+        credential = DefaultAzureCredential()
+        account_url = os.environ["STORAGE_QUEUE_URL"]
+        return QueueServiceClient(account_url=account_url, credential=credential)
+    else:
+        return QueueServiceClient.from_connection_string(os.environ["STORAGE_CONNECTION_STRING"])
+
+async def scan_latest_version(container_client) -> int:
+    """
+    Finds the newest model by listing all the model blobs.
+    Only used when the modeller has not published the manifest yet.
+    """
+    versions = [int(x.name.split("_")[1].split(".")[0]) async for x in container_client.list_blobs(name_starts_with="models/flowersmodel_") if x.name.endswith(".keras")]
+    return max(versions)
+
+class ManifestWatcher:
+    """
+    TTL cached reader of the model manifest.
+
+    Inside the TTL the cached manifest is returned without touching storage.
+    After it a conditional GET is made with the last seen ETag, so an unchanged
+    manifest costs one small 304 response.
+    """
+    def __init__(self, ttl_seconds: float = MANIFEST_TTL_SECONDS):
+        self._ttl = ttl_seconds
+        self._manifest = None
+        self._etag = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def get(self, container_client) -> dict:
+        async with self._lock:
+            if self._manifest is None or time.monotonic() - self._checked_at >= self._ttl:
+                self._manifest = await self._fetch(container_client)
+                self._checked_at = time.monotonic()
+            return self._manifest
+
+    async def _fetch(self, container_client) -> dict:
+        blob_client = container_client.get_blob_client(MANIFEST_BLOB)
+        try:
+            if self._etag is not None:
+                download = await blob_client.download_blob(etag=self._etag, match_condition=MatchConditions.IfModified)
+            else:
+                download = await blob_client.download_blob()
+            manifest_bytes = await download.readall()
+        except ResourceNotFoundError:
+            # no manifest yet, fall back to listing the models.
+            self._etag = None
+            return {"version": await scan_latest_version(container_client)}
+        except HttpResponseError as e:
+            if e.status_code != 304:
+                raise
+            return self._manifest
+
+        self._etag = download.properties.etag
+        return json.loads(manifest_bytes)
+
+manifest_watcher = ManifestWatcher()
+
+async def latest_manifest(container_client) -> dict:
+    """
+    returns the manifest of the latest model, version and its artifacts.
+    """
+    return await manifest_watcher.get(container_client)
+
+async def load_version_record(container_client, version: int) -> dict:
+    """
+    The manifest entry a version was published with, stored next to its files.
+    Versions from before records existed are full .keras files.
+    """
+    try:
+        download = await container_client.get_blob_client(f"models/flowersmodel_{version}.json").download_blob()
+        return json.loads(await download.readall())
+    except ResourceNotFoundError:
+        return {"version": version, "artifact": "full", "blob": f"models/flowersmodel_{version}.keras"}
+
+async def load_artifact(container_client, blob_name: str) -> bytearray:
     """
-    returns the value of latest saved model from blob storage
-    used to load newest model for prediction.
+    Downloads a model file with parallel ranged GETs into one preallocated buffer.
+    All the ranges are pinned to the same ETag, so a concurrent overwrite fails the
+    download instead of mixing two files.
     """
-    with get_blob_service_client() as blob_service_client:
-        container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
-        blobs = container_client.list_blobs(name_starts_with="models/")
-
-        latest = max([int(x.name.split("_")[1].split(".")[0]) for x in blobs])
-
-        unix_to_iso = datetime.fromtimestamp(latest).isoformat()
-        logging.info(f"Latest_model_version() seeing: {latest} created at {unix_to_iso}")
-        return latest
-
-@lru_cache(maxsize=5)
-def load_model(version:int):
-    # Find the latest model from /models folder in the storage container
-    # The model name follows the pattern model_{unix_seconds}.keras
-    with get_blob_service_client() as blob_service_client:
-        container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
-        blob_client = container_client.get_blob_client(f"models/flowersmodel_{version}.keras") 
-        logging.info(f"Loading model version {version}.")
-        logging.info(f"type {type(blob_client)}.")
-        
-        # https://stackoverflow.com/questions/74693871/why-joblib-is-not-recommended-when-saving-keras-model ### JOBLIBH ei toimninut.
-        # with BytesIO() as data:
-        #     logging.info(f"1")
-        #     logging.info(f"{data}")
-        #     blob_client.download_blob().readinto(data)
-        #     logging.info(f"{data}")
-        #     logging.info(f"2")
-        #     return joblib.load(data)
-
-        blob_data = blob_client.download_blob()
-        file_bytes = blob_data.readall()
-        logging.info(f"Downloaded model size: {len(file_bytes)} bytes.")
-        logging.info(f"type {type(file_bytes)}.")
-        return file_bytes
\ No newline at end of file
+    blob_client = container_client.get_blob_client(blob_name)
+    properties = await blob_client.get_blob_properties()
+    logging.info(f"Loading {blob_name}, {properties.size} bytes.")
+
+    # another replica or the modeller on this node may have fetched it already.
+    loop = asyncio.get_running_loop()
+    cached = await loop.run_in_executor(None, artifact_cache.get, blob_name, properties.etag)
+    if cached is not None:
+        return cached
+
+    buffer = bytearray(properties.size)
+    view = memoryview(buffer)
+    semaphore = asyncio.Semaphore(MODEL_DOWNLOAD_CONCURRENCY)
+
+    async def download_range(offset: int):
+        length = min(MODEL_CHUNK_BYTES, properties.size - offset)
+        async with semaphore:
+            stream = await blob_client.download_blob(
+                offset=offset,
+                length=length,
+                etag=properties.etag,
+                match_condition=MatchConditions.IfNotModified
+            )
+            view[offset:offset + length] = await stream.readall()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(download_range(offset) for offset in range(0, properties.size, MODEL_CHUNK_BYTES)))
+    logging.info(f"Downloaded {blob_name} in {time.perf_counter() - started:.2f} s.")
+
+    await loop.run_in_executor(None, artifact_cache.put, blob_name, properties.etag, buffer)
+    return buffer